@@ -2,10 +2,15 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 
+from account_mapping import AccountMapping
+from args import args
+from output_writer import write_frame
+
 # === FILE PATHS ===
 transaction_file = "Transaction List.xlsx"
 deposit_file = "DepositReport.xlsx"
-output_cleaned_file = "Cleaned_Transaction_List.xlsx"
+output_cleaned_file = "Cleaned_Transaction_List.arrow"
+output_cleaned_xlsx_file = "Cleaned_Transaction_List.xlsx"
 output_journal_file = "Vagaro_Journal_Entry.csv"
 
 # === STEP 1: READ FILES ===
@@ -80,8 +85,10 @@ if 'Membership' not in trans_df.columns:
 
 trans_df.loc[trans_df['Transaction Type'] == 'Membership', 'Membership'] = trans_df['Price']
 
-# Save cleaned transaction list
-trans_df.to_excel(output_cleaned_file, index=False)
+# Save cleaned transaction list as arrow so later stages can memory map it (xlsx only on request)
+write_frame(trans_df, output_cleaned_file)
+if args.export_xlsx:
+    trans_df.to_excel(output_cleaned_xlsx_file, index=False)
 
 # === JOURNAL ENTRY CREATION ===
 # Step 13: Bank deposit total
@@ -111,28 +118,33 @@ gift_card_liability = trans_df.loc[trans_df['Transaction Type'] == 'Gift Cards',
 gift_card_redemptions = trans_df.loc[trans_df['GiftCertificate No'].notna(), ['Customer','GC redeem']].dropna()
 redemption_total = gift_card_redemptions['GC redeem'].sum()
 
-# Adjust Massage Income to subtract gift card redemptions
-massage_income_adj = massage_income - redemption_total
-
-# Build journal entry
-journal_data = [
-    ["Vagaro", "01-017 Vagaro Fees", "", vagaro_fees],
-    ["Massage Therapy Customers", "02-003 Massage Income", massage_income_adj, ""],
-    ["Massage Therapy Customers", "02-004 Tips for Service Income", tips_income, ""],
-    ["Massage Therapy Customers", "02-008 Membership Income", membership_income, ""],
-    ["Massage Therapy Customers", "02-010 Discount Income", discount_income, ""],
-    ["Massage Therapy Customers", "05-003 Gift Card Liability", gift_card_liability, ""]
-]
+# Build journal entry (accounts are routed by the "vagaro" entry in the account mapping file)
+# NOTE: the mapping subtracts the gift card redemptions from the massage income
+mapping = AccountMapping(args.account_mapping).source('vagaro')
+totals = pd.DataFrame([{
+    "Vagaro Fees": vagaro_fees,
+    "Massage Income": massage_income,
+    "Gift Card Redemptions": redemption_total,
+    "Tips": tips_income,
+    "Membership Income": membership_income,
+    "Discount Income": discount_income,
+    "Gift Card Liability": gift_card_liability,
+}])
+lines = mapping.build_lines(totals)
+journal_df = pd.DataFrame({
+    'Received From': lines['payee'],
+    'Account': lines['account'],
+    'Debit': lines['debit'].astype(object).where(lines['debit'].notna(), ''),
+    'Credit': lines['credit'].astype(object).where(lines['credit'].notna(), ''),
+})
 
 # Add gift card redemption lines
-for _, row in gift_card_redemptions.iterrows():
-    journal_data.append([
-        row['Customer'], 
-        "02-003 Massage Income", 
-        row['GC redeem'], 
-        ""
-    ])
-
-journal_df = pd.DataFrame(journal_data, columns=['Received From','Account','Debit','Credit'])
-journal_df.to_csv(output_journal_file, index=False)
+redemption_lines = pd.DataFrame({
+    'Received From': gift_card_redemptions['Customer'],
+    'Account': mapping.row_accounts['gift_card_redemption'],
+    'Debit': gift_card_redemptions['GC redeem'],
+    'Credit': '',
+})
+journal_df = pd.concat([journal_df, redemption_lines], ignore_index=True)
+write_frame(journal_df, output_journal_file, journal_lines=args.intermediate)
 print("Cleanup and journal entry complete!")
\ No newline at end of file
@@ -4,31 +4,84 @@ import sys
 from args import args
 from data_importer import DataImporter
 from data_translator_from_journal import JournalDataImporter
+from equivalence_harness import EquivalenceHarness
 from installer import Installer
+from journal_consolidator import JournalConsolidator
+from job_scheduler import JobScheduler
+from mock_quickbooks_server import MockQuickBooksServer
+from quarantine_store import reprocess_quarantine
+from quickbooks_uploader import QuickBooksUploader
+from tenant_runner import TenantRunner
 
 if __name__ == '__main__':
     logging.info('Launched Climate Dev Bookkeepping tools')
 
     if args.install or args.reinstall:
-        installer = Installer(reinstall = args.reinstall)
+        installer = Installer(reinstall = args.reinstall, scheduler_config = args.scheduler_config)
         installer.install()
         sys.exit()
 
+    if args.run_scheduler:
+        scheduler = JobScheduler(args)
+        scheduler.run(once = args.scheduler_once)
+        sys.exit()
+
+    if args.serve_mock_quickbooks:
+        server = MockQuickBooksServer(port=args.mock_port, failure_rate=args.mock_failure_rate, throttle_rate=args.mock_throttle_rate)
+        server.serve()
+        sys.exit()
+
+    if args.reprocess_quarantine:
+        sys.exit(0 if reprocess_quarantine(args) else 1)
+
+    if args.check_equivalence:
+        harness = EquivalenceHarness(args)
+        sys.exit(0 if harness.run() else 1)
+
     # Check the date provided to ensure it is an integer in yyyymmdd format
     try:
         assert(len(str(args.date)) == 8)
     except AssertionError:
         raise Exception("The length of the date given is not correct. Make sure it is in yyyymmdd format (e.g. 20251031)")
 
+    # Run every job for every tenant on one shared pool
+    if args.run_tenants:
+        tenant_runner = TenantRunner.from_args(args)
+        tenant_runner.run(tenant_runner.build_jobs([args.date]))
+        sys.exit(0 if tenant_runner.print_summary() else 1)
+
+    # Output files from this run, in case they need to be uploaded
+    output_files = []
+
     # Chow now data importer
     if args.is_chow_now:
         data_importer = DataImporter(args)
 
-        data_importer.load_data()
-        data_importer.write_output_file()
+        if args.stream:
+            data_importer.stream_output_file()
+        else:
+            data_importer.load_data()
+            data_importer.write_output_file()
+        output_files.append(('chownow', data_importer.output_file))
 
     # Import from journal job
     if args.import_journal:
         journal_data_importer = JournalDataImporter(args)
 
         journal_data_importer.build_composite_dataframe()
+        output_files.append(('vagaro', journal_data_importer.output_file))
+
+    # Merge every source's journal files into one import file per period
+    if args.consolidate:
+        consolidator = JournalConsolidator(args)
+        consolidator.consolidate()
+
+    # Upload to quickbooks
+    if args.upload_quickbooks:
+        failed_uploads = 0
+        for source, output_file in ([(args.upload_source, args.upload_file)] if args.upload_file else output_files):
+            uploader = QuickBooksUploader(args)
+            failed_uploads += len(uploader.upload_file(output_file, source)['failed'])
+        if failed_uploads:
+            print(f"\n❌ {failed_uploads} journal entries failed to upload")
+            sys.exit(1)
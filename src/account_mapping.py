@@ -0,0 +1,217 @@
+'''
+Account routing for every job lives in one mapping file (src/config/account_mapping.json by default)
+
+For each source the file lists the journal lines to build, which account each one posts to, which side (debit or
+credit) and which report columns (or a pandas expression over them) feed the amount. The file is compiled once at
+startup and every importer then builds all of its journal lines with whole-column operations
+'''
+import pandas as pd
+import numpy as np
+import json
+import logging
+import os
+
+from string import Formatter
+
+from dates import format_dates, parse_dates
+
+DEFAULT_MAPPING_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'account_mapping.json')
+SIDES = ['debit', 'credit']
+LINE_COLUMNS = ['journal_date', 'journal_number', 'memo', 'payee', 'account', 'debit', 'credit']
+
+
+def load_mapping_file(file_path):
+    '''
+    Read the raw mapping from json, toml or yaml (toml needs python 3.11+ and yaml needs pyyaml)
+    '''
+    extension = os.path.splitext(file_path)[1].lower()
+    if not os.path.exists(file_path):
+        raise Exception(f"The account mapping file {file_path} is missing")
+
+    if extension == '.json':
+        with open(file_path) as f:
+            return json.load(f)
+    elif extension == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            raise Exception("Reading a toml account mapping requires python 3.11 or newer. Use json instead")
+        with open(file_path, 'rb') as f:
+            return tomllib.load(f)
+    elif extension in ['.yaml', '.yml']:
+        try:
+            import yaml
+        except ImportError:
+            raise Exception("Reading a yaml account mapping requires pyyaml. Install it with pip install pyyaml")
+        with open(file_path) as f:
+            return yaml.safe_load(f)
+    raise Exception(f"The account mapping file must be json, toml or yaml. Given {file_path}")
+
+
+class MappedLine:
+
+    def __init__(self, config):
+        '''
+        Compile a single journal line from the mapping file
+
+        Each line needs an account, a side and either a list of columns (summed, blanks count as 0) or an expression
+        Optional flags:
+            - absolute: post the absolute value of the amount
+            - positive_only: only post the line when the amount is above 0
+            - payee: override the source payee for this line
+        '''
+        self.account = config['account']
+        self.side = config['side'].lower()
+        self.columns = config.get('columns')
+        self.expression = config.get('expression')
+        self.absolute = config.get('absolute', False)
+        self.positive_only = config.get('positive_only', False)
+        self.payee = config.get('payee')
+
+        if self.side not in SIDES:
+            raise Exception(f"The side for account {self.account} must be one of {SIDES}. Given {self.side}")
+        if bool(self.columns) == bool(self.expression):
+            raise Exception(f"The line for account {self.account} needs exactly one of columns or expression")
+
+    def amounts(self, df):
+        '''
+        Compute this line's amount for every row of the report at once
+        '''
+        if self.expression:
+            amounts = pd.to_numeric(df.eval(self.expression, engine='python'), errors='coerce')
+        else:
+            # Added one column at a time so the float sums match adding them up by hand
+            amounts = pd.Series(0.0, index=df.index)
+            for column in self.columns:
+                if column in df:
+                    amounts = amounts + pd.to_numeric(df[column], errors='coerce').fillna(0)
+        amounts = amounts.to_numpy(dtype=float)
+        if self.absolute:
+            amounts = np.abs(amounts)
+        if self.positive_only:
+            amounts = np.where(amounts > 0, amounts, 0)
+        return amounts
+
+
+class SourceMapping:
+
+    def __init__(self, name, config):
+        '''
+        Compile the mapping for one source (chownow, spoton, vagaro...)
+
+        Journal numbers and memos are templates filled in per row. The available fields are:
+            - date: the row's date in date_format
+            - month_day: the row's date as mm/dd
+            - sequence: the row's position in the report, starting at 1
+        '''
+        self.name = name
+        self.date_column = config.get('date_column')
+        self.date_format = config.get('date_format', '%m/%d/%Y')
+        self.journal_number = config.get('journal_number', '')
+        self.memo = config.get('memo', '')
+        self.payee = config.get('payee', '')
+        self.skip_zero_lines = config.get('skip_zero_lines', True)
+        self.lines = [MappedLine(line) for line in config.get('lines', [])]
+        self.row_accounts = config.get('row_accounts', {})
+
+        self.journal_number_template = self.compile_template(self.journal_number)
+        self.memo_template = self.compile_template(self.memo)
+
+    def compile_template(self, template):
+        '''
+        Split a template into (literal, field) pairs once, so filling it in is just column concatenation
+        '''
+        parts = list(Formatter().parse(template))
+        for _, field, _, _ in parts:
+            if field is not None and field not in ['date', 'month_day', 'sequence']:
+                raise Exception(f"Unknown field {{{field}}} in the {self.name} template {template}")
+        return parts
+
+    def fill_template(self, parts, fields, length):
+        result = pd.Series([''] * length, dtype=object)
+        for literal, field, _, _ in parts:
+            result = result + literal
+            if field is not None:
+                result = result + fields[field]
+        return result.to_numpy()
+
+    def override_accounts(self, side, accounts):
+        '''
+        Rename the accounts of the lines on one side, in order. This keeps the old --accounts argument working
+        '''
+        side_lines = [line for line in self.lines if line.side == side]
+        for line, account in zip(side_lines, accounts):
+            line.account = account.strip()
+
+    def build_lines(self, df, sequence_start=1, on_rejected=None):
+        '''
+        Build every journal line for the given report rows
+
+        Lines come out grouped by report row, in the order they are listed in the mapping file
+        Lines with no amount (an expression over a blank cell) are always dropped, and lines of 0 unless skip_zero_lines
+        is turned off for the source
+
+        :param df: The report rows, already filtered down to the rows that need journal lines
+        :param sequence_start: The sequence of the first row, for when a report is built a chunk at a time
+        :param on_rejected: Optional callback given (rows, reason) for report rows that are skipped, with their original index
+        :return: A dataframe with LINE_COLUMNS, where debit and credit are floats that are blank on the other side
+        '''
+        original = df
+        df = df.reset_index(drop=True)
+        fields = {'sequence': pd.Series(np.arange(sequence_start, sequence_start + len(df))).astype(str)}
+
+        if self.date_column:
+            dates = parse_dates(df[self.date_column])
+            bad_dates = dates.isna()
+            if bad_dates.any():
+                logging.error(f"{self.name}: skipping {bad_dates.sum()} rows with a missing or bad {self.date_column}")
+                if on_rejected:
+                    on_rejected(original[bad_dates.to_numpy()], f'Missing or bad {self.date_column}')
+                df, dates, fields['sequence'] = df[~bad_dates], dates[~bad_dates], fields['sequence'][~bad_dates]
+                df, dates, fields['sequence'] = [item.reset_index(drop=True) for item in [df, dates, fields['sequence']]]
+            fields['date'] = format_dates(dates, self.date_format)
+            fields['month_day'] = format_dates(dates, '%m/%d')
+        else:
+            fields['date'] = fields['month_day'] = pd.Series([''] * len(df), dtype=object)
+
+        row_count, line_count = len(df), len(self.lines)
+        if row_count == 0 or line_count == 0:
+            return pd.DataFrame(columns=LINE_COLUMNS)
+
+        # Row major, so lines stay grouped by report row and in mapping order within the row
+        amounts = np.column_stack([line.amounts(df) for line in self.lines]).ravel()
+        rows = np.repeat(np.arange(row_count), line_count)
+        line_numbers = np.tile(np.arange(line_count), row_count)
+        keep = ~np.isnan(amounts)
+        if self.skip_zero_lines:
+            keep &= amounts != 0
+        amounts, rows, line_numbers = amounts[keep], rows[keep], line_numbers[keep]
+
+        is_debit = np.array([line.side == 'debit' for line in self.lines])[line_numbers]
+        payees = np.array([line.payee or self.payee for line in self.lines], dtype=object)[line_numbers]
+        return pd.DataFrame({
+            'journal_date': np.asarray(fields['date'], dtype=object)[rows],
+            'journal_number': self.fill_template(self.journal_number_template, fields, row_count)[rows],
+            'memo': self.fill_template(self.memo_template, fields, row_count)[rows],
+            'payee': payees,
+            'account': np.array([line.account for line in self.lines], dtype=object)[line_numbers],
+            'debit': np.where(is_debit, amounts, np.nan),
+            'credit': np.where(is_debit, np.nan, amounts),
+        })
+
+
+class AccountMapping:
+
+    def __init__(self, file_path=None):
+        '''
+        Load and compile the mapping file once. Defaults to src/config/account_mapping.json
+        '''
+        self.file_path = file_path or DEFAULT_MAPPING_FILE
+        self.sources = {
+            name: SourceMapping(name, config) for name, config in load_mapping_file(self.file_path).items()
+        }
+
+    def source(self, name):
+        if name not in self.sources:
+            raise Exception(f"The account mapping {self.file_path} has no entry for {name}")
+        return self.sources[name]
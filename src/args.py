@@ -1,17 +1,66 @@
 import argparse
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--output-file", type=str, help="File name for ouput from importing data. Default is output.csv", default="output.csv")
+parser.add_argument("--output-file", type=str, help="File name for ouput from importing data (.csv or .parquet). Default is output.csv", default="output.csv")
 parser.add_argument("--file-path", type=str, help="Path to the file to load data from. Default is ../data/", default="../data/")
 parser.add_argument("--date", type=int, help="Date you want to use for running the generator script (in yyyymmddformat) Default is 20240101", default=20240101)
 parser.add_argument("--accounts", type=str,
-                    help="Accounts required in the journal entry. Default is 02-002 Sales:Food and Beverage Sales, 02-004 Tip Income, 01-031 Delivery App Fees and Commissions:ChowNow fees and commissions, 02-007 Customer Refunds, 07-011 Taxes Payable:Sales and Restaurant Tax Payable",
-                    default="02-002 Sales:Food and Beverage Sales, 02-004 Tip Income, 01-031 Delivery App Fees and Commissions:ChowNow fees and commissions, 02-007 Customer Refunds, 07-011 Taxes Payable:Sales and Restaurant Tax Payable")
+                    help="Optional comma separated list of accounts that replace the ChowNow credit accounts from the account mapping, in order",
+                    default=None)
+parser.add_argument("--account-mapping", type=str,
+                    help="Mapping file (json, toml or yaml) routing report columns to accounts for every source. Default is src/config/account_mapping.json",
+                    default=None)
 parser.add_argument("--journal-keys", type=str,
                     help="Keys to include in a journal entry row. Default is Journal Date, Journal Number, Memo, Account, Debits, Credits",
                     default="Journal Date, Journal Number, Memo, Account, Debits, Credits")
+parser.add_argument("--batch-size", type=int, help="Number of journal lines written to the output file at a time. Default is 50000", default=50000)
+parser.add_argument("--stream", action="store_true", help="Read and write the ChowNow report a chunk of rows at a time so memory stays flat on multi-year exports")
+parser.add_argument("--chunk-size", type=int, help="Number of report rows read at a time with --stream. Default is 10000", default=10000)
+parser.add_argument("--skip-validation", action="store_true", help="Skip checking that every journal number balances before the output is written")
+parser.add_argument("--strict-validation", action="store_true", help="Refuse to write the output file if the journal lines fail validation")
+parser.add_argument("--no-intermediate", dest="intermediate", action="store_false", help="Don't write the arrow intermediate files shared between stages (normalized TL/DR reports and journal lines, in an intermediate/ folder)")
+parser.add_argument("--export-xlsx", action="store_true", help="Also write the cleaned Vagaro transaction list as xlsx. It is always written as arrow")
 parser.add_argument("--install", action="store_true", help="Indicates we want to install the job to run automatically via cron or task scheduler.")
 parser.add_argument("--reinstall", action="store_true", help="Indicates we want to reinstall (maybe we want to cheange the scheduler)")
 parser.add_argument("--is-chow-now", action="store_true", help="Indicates this run should process the chow now import job")
 parser.add_argument("--import-journal", action="store_true", help="Indicates this run should process the generic data importer job")
+parser.add_argument("--output-dir", type=str, help="Directory the journal job writes its output to. Default is ../data/", default="../data/")
+parser.add_argument("--run-tenants", action="store_true", help="Run every enabled job for every tenant in the tenants file on one shared worker pool")
+parser.add_argument("--tenants", type=str, help="Tenants file listing each business' data directory, account mapping and sources. Default is config/tenants.json", default="config/tenants.json")
+parser.add_argument("--workers", type=int, help="Number of worker processes shared by all tenant jobs. Default is the number of cpus", default=None)
+parser.add_argument("--max-jobs-per-tenant", type=int, help="Number of jobs for a single tenant that may run at the same time. Default is 1", default=1)
+parser.add_argument("--run-scheduler", action="store_true", help="Run the built in scheduler, which runs the scheduled jobs itself and catches up on any missed dates")
+parser.add_argument("--scheduler-config", type=str, help="Scheduler config written by the installer. Default is scheduler.json", default="scheduler.json")
+parser.add_argument("--scheduler-once", action="store_true", help="Only catch up on missed dates and run anything queued, then exit")
+parser.add_argument("--upload-quickbooks", action="store_true", help="Upload the journal entries generated in this run (or --upload-file) to Quickbooks. The access token is read from QUICKBOOKS_ACCESS_TOKEN")
+parser.add_argument("--upload-file", type=str, help="Existing journal file to upload instead of the output of this run", default=None)
+parser.add_argument("--upload-source", type=str, help="Which job (chownow, vagaro or spoton) wrote --upload-file. Not needed for consolidated files", default=None)
+parser.add_argument("--quickbooks-url", type=str, help="Base url of the Quickbooks API. Default is https://quickbooks.api.intuit.com", default="https://quickbooks.api.intuit.com")
+parser.add_argument("--quickbooks-realm", type=str, help="Quickbooks company id to upload the journal entries to", default=None)
+parser.add_argument("--quickbooks-accounts", type=str, help="Optional json file mapping account names to Quickbooks account ids", default=None)
+parser.add_argument("--upload-batch-size", type=int, help="Journal entries sent per batch request (max 30). Default is 30", default=30)
+parser.add_argument("--upload-concurrency", type=int, help="Number of batch requests in flight at once. Default is 4", default=4)
+parser.add_argument("--upload-retries", type=int, help="Number of times a throttled or failed batch is retried. Default is 5", default=5)
+parser.add_argument("--serve-mock-quickbooks", action="store_true", help="Run a local stand in for the Quickbooks API for offline testing")
+parser.add_argument("--mock-port", type=int, help="Port for the mock Quickbooks server. Default is 8765", default=8765)
+parser.add_argument("--mock-failure-rate", type=float, help="Share of requests the mock server fails with a 503. Default is 0", default=0.0)
+parser.add_argument("--mock-throttle-rate", type=float, help="Share of requests the mock server throttles with a 429. Default is 0", default=0.0)
+parser.add_argument("--consolidate", action="store_true", help="Merge the per-source journal outputs into one Quickbooks import file per period")
+parser.add_argument("--consolidate-inputs", type=str,
+                    help="Comma separated source=pattern pairs naming the journal files to merge. Default is the ChowNow, Vagaro and SpotOn outputs in ../data/",
+                    default="chownow=../data/*-chownow_journal_entry.csv,vagaro=../data/*-journal_entry.csv,spoton=../data/*-spoton_journal_entry.csv")
+parser.add_argument("--consolidate-period", type=str, help="Write one consolidated file per day, month or year. Default is month", default="month")
+parser.add_argument("--consolidate-output-dir", type=str, help="Directory the consolidated files are written to. Default is ../data/consolidated/", default="../data/consolidated/")
+parser.add_argument("--consolidate-format", type=str, help="Format of the consolidated files (csv, parquet or arrow). Default is csv", default="csv")
+parser.add_argument("--check-equivalence", action="store_true", help="Compare a candidate Vagaro journal translator with the current one on generated and recorded inputs")
+parser.add_argument("--equivalence-candidate", type=str,
+                    help="Translator to check, as module:attribute, called with (importer, transaction_df, deposit_df). Default is the current translator itself",
+                    default="data_translator_from_journal:JournalDataImporter.translate")
+parser.add_argument("--equivalence-generated", type=int, help="Number of generated TL/DR cases to run. Default is 1000", default=1000)
+parser.add_argument("--equivalence-seed", type=int, help="Seed of the first generated case. Default is 0", default=0)
+parser.add_argument("--equivalence-cases", type=str, help="Optional comma separated data directories whose arrow intermediates are replayed as recorded cases", default=None)
+parser.add_argument("--no-equivalence-cache", dest="equivalence_cache", action="store_false", help="Always rerun the legacy translator instead of reusing its cached output for each case")
+parser.add_argument("--equivalence-output", type=str, help="Directory minimized failing cases are saved to. Default is ../data/equivalence/", default="../data/equivalence/")
+parser.add_argument("--quarantine-db", type=str, help="Sqlite file recording the report rows and files a job had to reject. Default is quarantine.db", default="quarantine.db")
+parser.add_argument("--reprocess-quarantine", action="store_true", help="Rerun only the jobs that have quarantined rows or files, e.g. once the reports are fixed")
 args, unknown_args = parser.parse_known_args()
\ No newline at end of file
@@ -0,0 +1 @@
+"C:\ProgramData\Anaconda3\Python.exe" "C:\Program Files\DollarMountainBookkeeping\src\autorun\__init__.py" --run-scheduler
\ No newline at end of file
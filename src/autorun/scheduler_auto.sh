@@ -0,0 +1,3 @@
+#!/bin/bash
+cd ..
+python3.10 __init__.py --run-scheduler
\ No newline at end of file
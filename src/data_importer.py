@@ -3,7 +3,10 @@ import pandas as pd
 import logging
 import os
 
-from copy import deepcopy
+from account_mapping import AccountMapping
+from journal_validator import JournalValidator
+from output_writer import OutputWriter, SUPPORTED_FORMATS
+from quarantine_store import QuarantineStore, build_job
 
 class DataImporter:
 
@@ -16,48 +19,51 @@ class DataImporter:
         self.output_file = args.output_file
         self.file_path = args.file_path
         self.journal_keys = args.journal_keys.split(',')
-        self.accounts = args.accounts.split(',')
+        self.mapping = AccountMapping(args.account_mapping).source('chownow')
         self.date = args.date
-        self.journal_entries = []
-
-        if not self.output_file.endswith('.csv'):
-            raise Exception(f"The output file must be a CSV. Given {self.output_file}")
-
-    def build_row(self, row_data, debit=None, credit=None):
+        self.batch_size = args.batch_size
+        self.chunk_size = args.chunk_size
+        self.validate = not args.skip_validation
+        self.strict_validation = args.strict_validation
+        self.intermediate = args.intermediate
+        self.journal_entries = pd.DataFrame()
+        self.quarantine = QuarantineStore(args.quarantine_db, build_job('chownow', args)) if args.quarantine_db else None
+
+        # --accounts still renames the credit accounts, in order, for anyone relying on it
+        if args.accounts:
+            self.mapping.override_accounts('credit', args.accounts.split(','))
+
+        if os.path.splitext(self.output_file)[1].lower() not in SUPPORTED_FORMATS:
+            raise Exception(f"The output file must be one of {SUPPORTED_FORMATS}. Given {self.output_file}")
+
+    def build_output_rows(self, lines):
         '''
-        Given a row of data, apply some operations to set it up for excel
-        Every row should have either a debit or credit (but it need not have both)
+        Given the journal lines built from the account mapping, name the columns for excel
+        Every row has either a debit or credit (but it need not have both)
 
-        Row data is an array containing the following:
+        The first 4 journal keys name the following columns, in order:
             - date
             - journal number
             - memo
             - account
 
-        See args.py or --help for explanation on default accounts
+        See args.py or --help for explanation on the journal keys
         '''
-        if not debit and not credit:
-            return
-
-        row = {}
-        for index, entry in enumerate(row_data):
-            row[self.journal_keys[index]] = entry
-
-        if debit:
-            row["Debits"] = debit
-            print(row)
-
-        if credit:
-            row["Credits"] = credit
-        return row
-
+        return pd.DataFrame({
+            self.journal_keys[0]: lines['journal_date'],
+            self.journal_keys[1]: lines['journal_number'],
+            self.journal_keys[2]: lines['memo'],
+            self.journal_keys[3]: lines['account'],
+            "Credits": lines['credit'],
+            "Debits": lines['debit'],
+        })
 
     def load_data(self):
         '''
         Prepare the journal data for load into excel
+        Every summary row is turned into journal lines at once using the chownow account mapping
         '''
-        if not os.path.exists(self.file_path):
-            raise Exception(f"The file {self.file_path} is missing")
+        self.check_report_exists()
         try:
             self.df = pd.read_excel(self.file_path, engine='xlrd')
         except:
@@ -67,61 +73,110 @@ class DataImporter:
         logging.info(f"Available columns: {self.df.columns.tolist()}")
         summary_rows = self.df[self.df["Daily Total"].notna()]
 
-        for index, row in summary_rows.iterrows():
-            disbursement_date_raw = row.get("Disbursement Date")
-            if pd.isna(disbursement_date_raw):
-                logging.warning("Skipping row with missing Disbursement Date.")
-                continue
-
-            try:
-                date = pd.to_datetime(disbursement_date_raw).strftime("%m/%d/%Y")
-                journal_number = f"CN - Dep - {date[:-5]}"
-                memo = f"ChowNow Deposit {date}"
-            except Exception as e:
-                logging.error(f"kipping row with bad date format: {disbursement_date_raw} ({e})")
-                continue
-
-            # Extract data from the tow to perform calculations as needed
-            subtotal = row.get("Subtotal", 0) or 0
-            tip = row.get("In-house Tip", 0) or 0
-            tax = row.get("Tax", 0) or 0
-            discount = row.get("Discount", 0) or 0
-            daily_total = row.get("Daily Total", 0) or 0
-            refunds = row.get("Refund Amount", 0) or 0
-            fees = (row.get("Transaction Fee", 0) or 0) + \
-                (row.get("Finder's Fee", 0) or 0) + \
-                (row.get("External Partner Fee", 0) or 0)
-            sales_credit = subtotal + discount
-            credits = [sales_credit, tip, fees, refunds, tax]
-
-            rows_to_add = []
-            for index, account in enumerate(self.accounts):
-                row_data = [date, journal_number, memo, account]
-                rows_to_add.append(self.build_row(row_data, credit=credits[index]))
-
-            # Optional discounts- add only if provided
-            row_data = [date, journal_number, memo]
-            if discount > 0:
-                discount_data = deepcopy(row_data)
-                discount_data.append("02-006 Discount Income")
-                rows_to_add.append(self.build_row(discount_data, debit=discount))
-
-            # Set final account for debits
-            row_data.append("00-001 BUSINESS CHECKING (0050) - 1")
-            rows_to_add.append(self.build_row(row_data, debit=daily_total))
-
-            # Set data in journal entries to add
-            for row in rows_to_add:
-                if row:
-                    self.journal_entries.append(row)
+        self.journal_entries = self.build_output_rows(self.mapping.build_lines(summary_rows, on_rejected=self.quarantine_rows))
+
+    def check_report_exists(self):
+        if not os.path.exists(self.file_path):
+            if self.quarantine:
+                self.quarantine.record(self.file_path, 'file', 'The disbursement report is missing')
+            raise Exception(f"The file {self.file_path} is missing")
+
+    def quarantine_rows(self, rows, reason):
+        '''
+        Keep rows the mapping couldn't use in the quarantine, so they can be reprocessed once the report is fixed
+        '''
+        if self.quarantine:
+            self.quarantine.record_rows(self.file_path, rows, reason)
+
+    def read_report_chunks(self):
+        '''
+        Read the disbursement report a chunk of rows at a time
+
+        xlsx is read with openpyxl in read only mode, which streams rows out of the sheet instead of loading it
+        The old xls format has no streaming reader (xlrd always loads the whole workbook), so it is loaded once and
+        then chunked, which still avoids building every journal line in memory at once
+        '''
+        extension = os.path.splitext(self.file_path)[1].lower()
+        if extension == '.csv':
+            yield from pd.read_csv(self.file_path, chunksize=self.chunk_size)
+            return
+        if extension == '.xls':
+            logging.info("Old excel format detected, the whole report is loaded before it is streamed out")
+            df = pd.read_excel(self.file_path, engine='xlrd')
+            for start in range(0, len(df), self.chunk_size):
+                yield df.iloc[start:start + self.chunk_size]
+            return
+
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(self.file_path, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            logging.info(f"Available columns: {list(header)}")
+            # The index carries on across chunks, like pandas' own chunked readers, so rows keep their report position
+            chunk = []
+            start = 0
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == self.chunk_size:
+                    yield pd.DataFrame(chunk, columns=header, index=range(start, start + len(chunk)))
+                    start += len(chunk)
+                    chunk = []
+            if chunk:
+                yield pd.DataFrame(chunk, columns=header, index=range(start, start + len(chunk)))
+        finally:
+            workbook.close()
+
+    def stream_output_file(self):
+        '''
+        Read, translate, validate and write the report one chunk at a time, so memory stays flat however many years
+        the report covers. Each summary row becomes its own journal, so no journal is ever split across chunks
+
+        With strict validation the first chunk that fails stops the run and the previous output is left in place
+        '''
+        self.check_report_exists()
+        validator = JournalValidator('ChowNow', strict=self.strict_validation) if self.validate else None
+        sequence = 1
+
+        with OutputWriter(self.output_file, columns=self.journal_keys[:4] + ["Credits", "Debits"],
+                          journal_lines=self.intermediate) as writer:
+            for chunk in self.read_report_chunks():
+                summary_rows = chunk[chunk["Daily Total"].notna()]
+                entries = self.build_output_rows(self.mapping.build_lines(summary_rows, sequence_start=sequence,
+                                                                          on_rejected=self.quarantine_rows))
+                sequence += len(summary_rows)
+
+                if validator:
+                    validator.validate_chunk(entries)
+                    if self.strict_validation and not validator.report['valid']:
+                        break
+                writer.write_batch(entries)
+
+            # In strict mode this raises on a failed report, which discards the partly written output
+            if validator and validator.report:
+                validator.log_summary()
+                validator.write_report(self.output_file)
+        print(f"\n✅ Finished! Journal entries saved to: {self.output_file}")
 
     def write_output_file(self):
         '''
         Write to the final output file given by the input arguments
-        Note the error is thrown in init if this is non csv as only csv is supported for now (sorry not sorry)
+        Note the error is thrown in init if this is not a csv or parquet file
+
+        Entries are streamed out in batches to a temp file that replaces the output only once complete
         '''
+        if self.validate:
+            validator = JournalValidator('ChowNow', strict=self.strict_validation)
+            validator.validate(self.journal_entries)
+            validator.write_report(self.output_file)
+
         try:
-            pd.DataFrame(self.journal_entries).to_csv(self.output_file, index=False)
+            with OutputWriter(self.output_file, columns=self.journal_entries.columns, journal_lines=self.intermediate) as writer:
+                for start in range(0, len(self.journal_entries), self.batch_size):
+                    writer.write_batch(self.journal_entries.iloc[start:start + self.batch_size])
         except Exception as e:
             logging.error(f"There was an error writing the output file: {e}")
         print(f"\n✅ Finished! Journal entries saved to: {self.output_file}")
@@ -43,8 +43,12 @@ class VagaroFeeDataRow(BaseDataRow):
 
 class DataRowFactory:
 
-    def __init__(self):
+    def __init__(self, accounts=None):
+        '''
+        :param accounts: Optional account names by data type (from the account mapping) overriding the defaults above
+        '''
         self.data_types = []
+        self.accounts = accounts or {}
 
     def add_data_type(self, data_type):
         if data_type == '':
@@ -53,6 +57,13 @@ class DataRowFactory:
             self.data_types.append(data_type)
 
     def build_data_row(self, data_type=''):
+        row = self._build_default_data_row(data_type)
+        account_name = self.accounts.get(data_type.lower() or 'totals')
+        if account_name:
+            row['Account Name'] = account_name
+        return row
+
+    def _build_default_data_row(self, data_type=''):
         self.add_data_type(data_type)
         if data_type.lower() == 'income':
             return IncomeDataRow()._get_all_level_attributes()
@@ -5,9 +5,16 @@ import numpy as np
 import logging
 import os
 
-from datetime import datetime
-
+from account_mapping import AccountMapping
 from data_row_builder import DataRowFactory
+from dates import format_date_key
+from intermediate_store import IntermediateStore
+from journal_validator import JournalValidator
+from output_writer import write_frame
+from quarantine_store import QuarantineStore, build_job
+
+# The money columns translate reads from the TL and DR reports. A bad cell in any other column can't change the journal
+TRANSLATED_MONEY_COLUMNS = ['Price', 'Tip', 'Disc', 'Amt paid', 'NetAmount', 'Fee']
 
 class JournalDataImporter:
 
@@ -15,9 +22,14 @@ class JournalDataImporter:
         self.date = args.date
         self.file_path = args.file_path
         self.journal_keys = args.journal_keys.split(',')
-        self.file_list = self.load_source_data_file()
-        self.output_file = f'../data/{self.date}-journal_entry.csv'
-        self.journal_date = datetime.strptime(str(self.date), "%Y%m%d").strftime("%m/%d/%Y")
+        self.batch_size = args.batch_size
+        self.row_accounts = AccountMapping(args.account_mapping).source('vagaro_journal').row_accounts
+        self.validate = not args.skip_validation
+        self.strict_validation = args.strict_validation
+        self.store = IntermediateStore(self.file_path) if args.intermediate else None
+        self.quarantine = QuarantineStore(args.quarantine_db, build_job('vagaro', args)) if args.quarantine_db else None
+        self.output_file = os.path.join(args.output_dir, f'{self.date}-journal_entry.csv')
+        self.journal_date = format_date_key(self.date, "%m/%d/%Y")
 
     def load_source_data_file(self):
         '''
@@ -82,26 +94,56 @@ class JournalDataImporter:
 
     def build_composite_dataframe(self):
         '''
-        This loads in the relevant transactions and deposits files for the given dates
+        This loads in the relevant transactions and deposits files for the given date, translates them into journal
+        lines and writes the output file
+        '''
+        transaction_df, deposit_df = self.load_source_frames()
+        self.translate(transaction_df, deposit_df)
 
-        Then, we build the dataframe out to house the data with the given rules:
-            # TODO: once you understand the rules, fill this out
+        # Check the journal balances before we write it out
+        if self.validate:
+            validator = JournalValidator('Vagaro', strict=self.strict_validation)
+            validator.validate(self.output_df)
+            validator.write_report(self.output_file)
+
+        # Write to final csv file
+        self.write_csv()
+
+    def load_source_frames(self):
         '''
-        self.output_df = pd.DataFrame(columns=self.journal_keys)
+        Find and load the transactions (TL) and deposits (DR) reports for the date
+        '''
+        self.file_list = self.load_source_data_file()
+        frames = {}
         for file in self.file_list:
             if '-TL' in file:
                 # Then it's a transaction file
-                transaction_df = pd.read_excel(file, engine='openpyxl', skiprows=22)
+                frames['transactions'] = self.load_source_frame(file, 'transactions', skiprows=22, writable=True)
             elif '-DR' in file:
                 # Then it's a deposit file
-                deposit_df = pd.read_excel(file, engine='openpyxl')
+                frames['deposits'] = self.load_source_frame(file, 'deposits')
             else:
                 logging.warning(f'An unknown file {file} was found that does not match a deposit or transaction file. Skipping.')
                 continue
 
-        # Remove currency sign and change () to negative
-        self.excel_currency_to_signed_float(deposit_df)
-        self.excel_currency_to_signed_float(transaction_df)
+        missing = [(dataset, report) for dataset, report in [('transactions', 'TL'), ('deposits', 'DR')] if dataset not in frames]
+        for dataset, report in missing:
+            expected = os.path.join(self.file_path, f'{self.date}-{report}*.xlsx')
+            if self.quarantine:
+                self.quarantine.record(expected, 'file', f'The {report} ({dataset}) report is missing')
+        if missing:
+            raise Exception(f"No {' or '.join(report for _, report in missing)} report for {self.date} was found in {self.file_path}")
+        return frames['transactions'], frames['deposits']
+
+    def translate(self, transaction_df, deposit_df):
+        '''
+        Build the journal lines from the transactions and deposits frames, entirely in memory
+        The frames are edited in place. Sets and returns self.output_df
+
+        We build the dataframe out to house the data with the given rules:
+            # TODO: once you understand the rules, fill this out
+        '''
+        self.output_df = pd.DataFrame(columns=self.journal_keys)
 
         # Fix broken discount data
         transaction_df = self.maybe_load_discounts(transaction_df)
@@ -121,7 +163,7 @@ class JournalDataImporter:
             # Each row may have profit and fee information associated with it
             # The code at the end ensures these are separate row numbers on the final csv
             if has_single_debit is False:
-                data_row_factory = DataRowFactory()
+                data_row_factory = DataRowFactory(self.row_accounts)
 
             # Match the transaction ids between the 2 dataframes
             transaction_number = entry['Transaction ID']
@@ -242,28 +284,114 @@ class JournalDataImporter:
             # Garbage collection
             del data_row_factory
 
-        # Write to final csv file
-        self.write_csv()
+        return self.output_df
+
+    def load_source_frame(self, file, dataset, skiprows=None, writable=False):
+        '''
+        Load a transaction or deposit report with the currency already converted to signed floats
+
+        The normalized frame is kept as an arrow intermediate, so later runs for the same date (reruns, reprocessing,
+        the equivalence check) memory map it rather than parsing the excel file again
+
+        :param writable: Copy it out of the memory map. translate edits the transactions in place, the deposits are
+            only read so they stay views of the file
+        '''
+        if self.store and self.store.is_fresh(self.date, dataset, source_file=file):
+            logging.info(f'Loading {dataset} for {self.date} from the arrow intermediate')
+            return self.store.read(self.date, dataset, writable=writable)
+
+        df = pd.read_excel(file, engine='openpyxl', skiprows=skiprows)
+
+        # Remove currency sign and change () to negative. A report with an amount we can't read raises here, so it's
+        # never cached and reprocessing reads the excel again
+        df = self.excel_currency_to_signed_float(df, file=file, header_rows=skiprows or 0)
+
+        if self.store:
+            self.store.write(self.date, dataset, df, lossless=True)
+        return df
 
     def write_csv(self):
         '''
         Given a compiled dataframe, write the result to csv, logging any errors
+        The file is only replaced once the write completes, so a failed run never leaves a partial csv
         '''
         try:
-            self.output_df.to_csv(self.output_file, index=False)
+            write_frame(self.output_df, self.output_file, batch_size=self.batch_size, journal_lines=bool(self.store))
             logging.info(f'Output file written: {self.output_file}')
         except Exception as e:
             logging.error(f'Unable to write to file: {e}')
 
-    def excel_currency_to_signed_float(self, df):
+    def excel_currency_to_signed_float(self, df, file=None, header_rows=0):
         '''
         This takes an excel value that contains $ and () and converts it to signed float we can use
+
+        Money columns with blank cells are still converted, the blanks are left as NaN. Vagaro books one journal for the
+        whole date, so a row can't just be dropped: a cell that can't be read as money in a column translate uses has its
+        row quarantined and the date raises, so nothing is written for it until the report is fixed and reprocessed.
+        Anywhere else the bad cell is only logged and left as it is
+
+        :param file: The report the frame was loaded from, for the quarantine
+        :param header_rows: Rows skipped above the header, so quarantined rows point at the right row in the sheet
         '''
+        raw = df.copy()
+        unreadable_columns = []
         for column in df.columns:
+            original = df[column]
             try:
                 df[column] = df[column].str.replace('$', '', regex=False)
                 df[column] = df[column].apply(lambda x: -float(x.strip('()')) if '(' in x else float(x))
+                continue
             except (AttributeError, ValueError, TypeError):
+                df[column] = original
+
+            bad_cells = self.unreadable_currency_cells(original)
+            if bad_cells is None:
                 # Not a float, leave alone
                 continue
+            converted = original.mask(bad_cells).apply(lambda x: self.currency_to_float(x) if isinstance(x, str) else x)
+            df[column] = converted.where(~bad_cells, original)
+            if not bad_cells.any():
+                continue
+
+            for index in bad_cells[bad_cells].index:
+                logging.error(f'Unreadable amount {original[index]!r} in {column}, row {index + header_rows + 2} of {file}')
+            if column not in TRANSLATED_MONEY_COLUMNS:
+                logging.warning(f'{column} is not used for the journal, so {file} is still translated')
+                continue
+            unreadable_columns.append(column)
+            if self.quarantine:
+                self.quarantine.record_rows(file, raw[bad_cells], f'Unreadable amount in {column}', header_rows=header_rows)
+
+        if unreadable_columns:
+            raise Exception(
+                f"{file} has unreadable amounts in {unreadable_columns}, nothing is written for {self.date} until it's "
+                "fixed and reprocessed"
+            )
+        return df
+
+    def currency_to_float(self, value):
+        '''
+        One currency cell ("$1,234.50" or "($12.00)") as a signed float. Raises ValueError if it isn't money
+        '''
+        text = value.replace('$', '').replace(',', '').strip()
+        if text.startswith('(') and text.endswith(')'):
+            return -float(text[1:-1])
+        return float(text)
+
+    def unreadable_currency_cells(self, column):
+        '''
+        For a column of money (any cell has a $ in it), flag the text cells that can't be read as money
+        Returns None for any other column, which is left as it is
+        '''
+        if not any(isinstance(value, str) and '$' in value for value in column):
+            return None
+
+        def unreadable(value):
+            try:
+                self.currency_to_float(value)
+                return False
+            except ValueError:
+                return True
+
+        return column.map(lambda value: isinstance(value, str) and unreadable(value)).astype(bool)
 
@@ -0,0 +1,94 @@
+'''
+Date parsing and formatting shared by every importer
+
+A report has thousands of rows but only a handful of distinct dates, so whole columns are parsed and formatted by
+working on the unique values once and mapping the results back. Formats are compiled once and the no leading zero
+directives (%#m on Windows, %-m on Linux and mac) are handled here, so they give the same output on every platform
+'''
+import pandas as pd
+import numpy as np
+import re
+
+from functools import lru_cache
+
+# The no leading zero directives and the date part each one writes
+UNPADDED_DIRECTIVES = {'m': 'month', 'd': 'day', 'H': 'hour', 'M': 'minute', 'S': 'second', 'j': 'dayofyear'}
+UNPADDED_PATTERN = re.compile(r'%[#-]([' + ''.join(UNPADDED_DIRECTIVES) + '])')
+
+
+@lru_cache(maxsize=None)
+def compile_format(date_format):
+    '''
+    Split a strftime format into plain strftime pieces and unpadded date parts
+
+    "%#m/%#d/%Y" -> [('part', 'month'), ('strftime', '/'), ('part', 'day'), ('strftime', '/%Y')]
+    '''
+    pieces = []
+    position = 0
+    for match in UNPADDED_PATTERN.finditer(date_format):
+        if match.start() > position:
+            pieces.append(('strftime', date_format[position:match.start()]))
+        pieces.append(('part', UNPADDED_DIRECTIVES[match.group(1)]))
+        position = match.end()
+    if position < len(date_format):
+        pieces.append(('strftime', date_format[position:]))
+    return tuple(pieces)
+
+
+def parse_dates(values, date_format=None):
+    '''
+    Parse a column of dates, each distinct value only once. Anything that isn't a date becomes NaT
+
+    :param values: A series of dates as text, datetimes or excel values
+    :param date_format: Optional strptime format. Without it each value's format is worked out on its own, so a
+        column mixing e.g. 2025-07-16 and 07/17/2025 still parses
+    '''
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    codes, uniques = pd.factorize(values)
+    # Left to itself pandas guesses one format from the first value and turns everything else into NaT
+    parsed = pd.to_datetime(pd.Series(uniques, dtype=object), format=date_format or 'mixed', errors='coerce').to_numpy()
+    # Missing values have code -1, which picks up the NaT added on the end
+    return pd.Series(np.append(parsed, np.datetime64('NaT')).take(codes), index=values.index)
+
+
+def format_unique_dates(dates, date_format):
+    '''
+    Format an index of distinct (non missing) dates
+    '''
+    formatted = np.full(len(dates), '', dtype=object)
+    for kind, value in compile_format(date_format):
+        if kind == 'part':
+            formatted = formatted + getattr(dates, value).astype(str).to_numpy(dtype=object)
+        else:
+            formatted = formatted + dates.strftime(value).to_numpy(dtype=object)
+    return formatted
+
+
+def format_dates(dates, date_format):
+    '''
+    Format a column of dates, each distinct date only once. Missing dates become blank strings
+    '''
+    dates = pd.Series(dates)
+    codes, uniques = pd.factorize(dates)
+    formatted = format_unique_dates(pd.DatetimeIndex(uniques), date_format)
+    return pd.Series(np.append(formatted, '')[codes], index=dates.index, dtype=object)
+
+
+def date_keys(dates):
+    '''
+    A column of dates as yyyymmdd integers, the format of --date and the journal numbers. Missing dates become <NA>
+    '''
+    dates = pd.Series(dates)
+    return (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).astype('Int64')
+
+
+@lru_cache(maxsize=4096)
+def format_date_key(date_key, date_format):
+    '''
+    Format a yyyymmdd date (like --date) the same way format_dates would, cached since the same dates come up in
+    every job of a run
+    '''
+    date = pd.to_datetime(str(date_key), format='%Y%m%d')
+    return format_unique_dates(pd.DatetimeIndex([date]), date_format)[0]
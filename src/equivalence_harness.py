@@ -0,0 +1,415 @@
+'''
+Checks a new Vagaro journal translator against the current one before it goes anywhere near the books
+
+Both translators are run side by side on generated TL/DR inputs and on recorded ones (any data directory with arrow
+intermediates, see intermediate_store.py), spread over worker processes. The outputs are compared line by line in whole
+cents. Any case where they differ is cut down to the fewest transaction and deposit rows that still show the difference,
+and saved so it can be replayed
+
+The legacy translator is slow and never changes between runs, so its output for each case is cached as arrow under the
+output dir, keyed on a hash of its code and the account mapping. Repeat runs while working on a candidate only pay for
+the candidate
+
+A candidate is given as module:attribute, e.g. fast_translator:translate. It is called as
+candidate(importer, transaction_df, deposit_df) and returns the journal lines dataframe, the same as
+JournalDataImporter.translate. If both translators raise the same type of exception the case counts as equivalent
+'''
+import argparse
+import glob
+import hashlib
+import importlib
+import logging
+import os
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from account_mapping import DEFAULT_MAPPING_FILE
+from intermediate_store import IntermediateStore, read_arrow_frame
+from journal_schema import UNIFIED_COLUMNS, normalize_journal_frame
+from output_writer import arrow_table_from_frame
+from tenant_runner import VAGARO_JOURNAL_KEYS
+
+LEGACY_TRANSLATOR = 'data_translator_from_journal:JournalDataImporter.translate'
+TRANSACTION_TYPES = ['Services', 'Service Add-on', 'Membership', 'Product', 'Gift Card']
+CASES_PER_TASK = 25
+
+
+def load_translator(spec):
+    '''
+    Import a translator from module:attribute, where the attribute may be a dotted path like Class.method
+    '''
+    if ':' not in spec:
+        raise Exception(f"Translators are given as module:attribute. Given {spec}")
+    module_name, attribute = spec.split(':', 1)
+    translator = importlib.import_module(module_name)
+    for part in attribute.split('.'):
+        translator = getattr(translator, part)
+    return translator
+
+
+def generate_case(seed):
+    '''
+    Build a random but realistic TL/DR pair. Amounts are whole cents, a few deposits are refunds (negative net) and
+    some transactions never make it onto the deposit report
+    '''
+    rng = random.Random(seed)
+    count = rng.randint(1, 12)
+    prices = [rng.randint(0, 20000) / 100 for _ in range(count)]
+    tips = [rng.choice([0, 0, rng.randint(1, 3000) / 100]) for _ in range(count)]
+    discounts = [rng.choice([0, 0, 0, rng.randint(1, 1000) / 100]) for _ in range(count)]
+    transaction_df = pd.DataFrame({
+        'Checkout Date': pd.Timestamp('2025-07-01'),
+        'Customer': [f'customer {index}' for index in range(count)],
+        'Transaction ID': [f'T{seed}-{index}' for index in range(count)],
+        'Transaction Type': [rng.choice(TRANSACTION_TYPES) for _ in range(count)],
+        'Qty': [rng.randint(1, 3) for _ in range(count)],
+        'Price': prices,
+        'Tip': tips,
+        'Amt paid': [round(price + tip - discount, 2) for price, tip, discount in zip(prices, tips, discounts)],
+        'Disc': 0.0,
+    })
+
+    deposited = [index for index in range(count) if rng.random() < 0.7]
+    fees = [rng.randint(0, 500) / 100 for _ in deposited]
+    deposit_df = pd.DataFrame({
+        'TranNum': [f'T{seed}-{index}' for index in deposited],
+        'NetAmount': [round(transaction_df['Amt paid'][index] - fee, 2) for index, fee in zip(deposited, fees)],
+        'Fee': fees,
+        'Name': [f'customer {index}' for index in deposited],
+    })
+    if len(deposit_df) and rng.random() < 0.2:
+        refund = rng.randrange(len(deposit_df))
+        deposit_df.loc[refund, 'NetAmount'] = -abs(deposit_df.loc[refund, 'NetAmount']) or -1.0
+    return {'name': f'generated-{seed}', 'date': 20250701, 'transactions': transaction_df, 'deposits': deposit_df}
+
+
+def find_recorded_cases(data_dirs):
+    '''
+    Every date with both a transactions and a deposits intermediate in a data directory is a recorded case
+    '''
+    cases = []
+    for data_dir in data_dirs:
+        store = IntermediateStore(data_dir)
+        for path in sorted(glob.glob(os.path.join(store.directory, '*-transactions.arrow'))):
+            name = os.path.basename(path)[:-len('-transactions.arrow')]
+            if os.path.exists(store.path(name, 'deposits')):
+                cases.append({'name': name, 'data_dir': data_dir})
+    return cases
+
+
+def load_recorded_case(case):
+    store = IntermediateStore(case['data_dir'])
+    date = int(case['name']) if case['name'].isdigit() and len(case['name']) == 8 else 20250701
+    return {
+        'name': case['name'],
+        'date': date,
+        'transactions': store.read(case['name'], 'transactions', writable=True),
+        'deposits': store.read(case['name'], 'deposits', writable=True),
+    }
+
+
+def build_importer(date, account_mapping=None):
+    '''
+    A translator instance that is only used in memory, so it never touches a data directory
+    '''
+    from data_translator_from_journal import JournalDataImporter
+
+    return JournalDataImporter(argparse.Namespace(
+        date=date, file_path='.', journal_keys=VAGARO_JOURNAL_KEYS, batch_size=50000, account_mapping=account_mapping,
+        skip_validation=True, strict_validation=False, intermediate=False, output_dir='.', quarantine_db=None,
+    ))
+
+
+def run_translator(translator, case, account_mapping=None):
+    '''
+    Run one translator on a copy of the case. Returns (normalized journal lines, None) or (None, exception type name)
+    '''
+    importer = build_importer(case['date'], account_mapping)
+    try:
+        output = translator(importer, case['transactions'].copy(), case['deposits'].copy())
+    except Exception as e:
+        return None, type(e).__name__
+    return normalize_journal_frame(output).reset_index(drop=True), None
+
+
+def legacy_fingerprint(account_mapping=None):
+    '''
+    Hash of everything the legacy translator's output depends on besides its input
+    '''
+    import data_row_builder
+    import data_translator_from_journal
+    import journal_schema
+
+    digest = hashlib.sha256()
+    for file_path in [data_translator_from_journal.__file__, data_row_builder.__file__, journal_schema.__file__,
+                      account_mapping or DEFAULT_MAPPING_FILE]:
+        with open(file_path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class LegacyCache:
+
+    def __init__(self, directory, fingerprint):
+        '''
+        Normalized legacy output per case, one arrow file each. A case the legacy translator raised on is stored as a
+        single row holding the exception type
+        '''
+        self.directory = os.path.join(directory, 'legacy-cache', fingerprint)
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.arrow')
+
+    def get(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+        frame = read_arrow_frame(self.path(key), writable=True)
+        if 'error' in frame:
+            return None, frame['error'].iloc[0]
+        return frame, None
+
+    def put(self, key, result):
+        '''
+        Written straight through arrow rather than the output writer, which reports every file it writes
+        '''
+        import pyarrow as pa
+
+        lines, error = result
+        table = arrow_table_from_frame(pd.DataFrame({'error': [error]}) if error else lines, lossless=True)
+        os.makedirs(self.directory, exist_ok=True)
+        temp_file = f'{self.path(key)}.{os.getpid()}.tmp'
+        with pa.OSFile(temp_file, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(temp_file, self.path(key))
+
+
+def case_key(task):
+    '''
+    Generated cases are identified by their seed, recorded ones by name and when their intermediates last changed
+    '''
+    if 'seed' in task:
+        return f"generated-{task['seed']}"
+    store = IntermediateStore(task['data_dir'])
+    modified = max(os.path.getmtime(store.path(task['name'], dataset)) for dataset in ['transactions', 'deposits'])
+    source = f"{os.path.abspath(task['data_dir'])}/{task['name']}/{modified}"
+    return f"recorded-{hashlib.sha256(source.encode()).hexdigest()[:16]}"
+
+
+def line_differences(legacy_lines, candidate_lines):
+    '''
+    Flag every line where the two outputs differ. Cents are nullable and NA comparisons are skipped by pandas, so the
+    NA positions are compared explicitly: an amount only one side couldn't read is a difference, while the same
+    unreadable amount on both sides (e.g. the $nan written for a blank Tip) matches and is reported on its own
+    '''
+    differences = np.zeros(len(legacy_lines), dtype=bool)
+    for column in UNIFIED_COLUMNS:
+        legacy_missing = legacy_lines[column].isna().to_numpy()
+        candidate_missing = candidate_lines[column].isna().to_numpy()
+        legacy_values = legacy_lines[column].astype(object).where(~legacy_missing, None).to_numpy()
+        candidate_values = candidate_lines[column].astype(object).where(~candidate_missing, None).to_numpy()
+        differences |= (legacy_missing != candidate_missing) | (~legacy_missing & (legacy_values != candidate_values))
+    return differences
+
+
+def unreadable_amounts(lines):
+    '''
+    How many journal lines have an amount that can't be read as money
+    '''
+    if lines is None:
+        return 0
+    return int((lines['debit_cents'].isna() | lines['credit_cents'].isna()).sum())
+
+
+def garbage_amounts_translator(importer, transaction_df, deposit_df):
+    '''
+    A known bad candidate: the legacy output with the totals line's amounts replaced by text. Used to check the
+    comparison itself still catches unreadable money before any real candidate is trusted
+    '''
+    from data_translator_from_journal import JournalDataImporter
+
+    output = JournalDataImporter.translate(importer, transaction_df, deposit_df)
+    if len(output):
+        output.loc[output.index[-1], ['Debits', 'Credits']] = 'oops'
+    return output
+
+
+def check_comparison():
+    '''
+    Make sure the garbage amounts candidate fails on a generated case the legacy translator can handle
+    '''
+    legacy = load_translator(LEGACY_TRANSLATOR)
+    for seed in range(100):
+        case = generate_case(seed)
+        legacy_lines, legacy_error = run_translator(legacy, case)
+        if legacy_error or not len(legacy_lines):
+            continue
+        if compare_case(legacy, garbage_amounts_translator, case, legacy_result=(legacy_lines, legacy_error)) is None:
+            raise Exception("The equivalence check passed a candidate writing garbage amounts, the comparison is broken")
+        return
+    raise Exception("No generated case could be translated to check the comparison with")
+
+
+def compare_case(legacy, candidate, case, account_mapping=None, legacy_result=None, candidate_result=None):
+    '''
+    Run both translators on the case and describe the first difference, or return None if they agree
+
+    :param legacy_result: The legacy translator's result for this case if it is already known
+    :param candidate_result: The same for the candidate
+    '''
+    legacy_lines, legacy_error = legacy_result or run_translator(legacy, case, account_mapping)
+    candidate_lines, candidate_error = candidate_result or run_translator(candidate, case, account_mapping)
+
+    if legacy_error or candidate_error:
+        if legacy_error == candidate_error:
+            return None
+        return f'legacy {"raised " + legacy_error if legacy_error else "succeeded"}, ' \
+               f'candidate {"raised " + candidate_error if candidate_error else "succeeded"}'
+
+    if len(legacy_lines) != len(candidate_lines):
+        return f'legacy wrote {len(legacy_lines)} lines, candidate wrote {len(candidate_lines)}'
+    differences = line_differences(legacy_lines, candidate_lines)
+    if differences.any():
+        line = int(np.argmax(differences))
+        return f'line {line} differs: legacy {legacy_lines.iloc[line].to_dict()}, candidate {candidate_lines.iloc[line].to_dict()}'
+    return None
+
+
+def minimize_case(legacy, candidate, case, account_mapping=None):
+    '''
+    Drop transaction and deposit rows, in halves then smaller pieces, for as long as the translators still disagree
+    '''
+    def still_fails(transaction_df, deposit_df):
+        trial = dict(case, transactions=transaction_df, deposits=deposit_df)
+        return compare_case(legacy, candidate, trial, account_mapping) is not None
+
+    frames = {'transactions': case['transactions'].reset_index(drop=True), 'deposits': case['deposits'].reset_index(drop=True)}
+    changed = True
+    while changed:
+        changed = False
+        for dataset in ['transactions', 'deposits']:
+            size = max(len(frames[dataset]) // 2, 1)
+            while size >= 1 and len(frames[dataset]):
+                start = 0
+                while start < len(frames[dataset]):
+                    reduced = frames[dataset].drop(index=range(start, min(start + size, len(frames[dataset])))).reset_index(drop=True)
+                    trial = dict(frames, **{dataset: reduced})
+                    if still_fails(trial['transactions'], trial['deposits']):
+                        frames[dataset] = reduced
+                        changed = True
+                    else:
+                        start += size
+                size //= 2
+    return dict(case, **frames)
+
+
+def run_cases(tasks, legacy_spec, candidate_spec, account_mapping=None, cache=None):
+    '''
+    Worker entry point: run a batch of cases and return a result for every one that failed, with its minimized input,
+    and every case whose output has unreadable amounts (on either side, whether or not they match)
+    '''
+    legacy = load_translator(legacy_spec)
+    candidate = load_translator(candidate_spec)
+    failures = []
+    unreadable = []
+    for task in tasks:
+        case = generate_case(task['seed']) if 'seed' in task else load_recorded_case(task)
+        legacy_result = cache.get(case_key(task)) if cache else None
+        if legacy_result is None:
+            legacy_result = run_translator(legacy, case, account_mapping)
+            if cache:
+                cache.put(case_key(task), legacy_result)
+        candidate_result = run_translator(candidate, case, account_mapping)
+        difference = compare_case(legacy, candidate, case, account_mapping, legacy_result=legacy_result,
+                                  candidate_result=candidate_result)
+        counts = {'legacy': unreadable_amounts(legacy_result[0]), 'candidate': unreadable_amounts(candidate_result[0])}
+        if any(counts.values()):
+            unreadable.append(dict(counts, name=case['name']))
+        if difference:
+            minimized = minimize_case(legacy, candidate, case, account_mapping)
+            failures.append({
+                'name': case['name'],
+                'difference': difference,
+                'minimized_difference': compare_case(legacy, candidate, minimized, account_mapping),
+                'date': case['date'],
+                'transactions': minimized['transactions'],
+                'deposits': minimized['deposits'],
+            })
+    return len(tasks), failures, unreadable
+
+
+class EquivalenceHarness:
+
+    def __init__(self, args):
+        '''
+        Create the harness from the argument list passed in
+
+        See args.py or --help for documentation on the args
+        '''
+        self.candidate = args.equivalence_candidate
+        self.generated = args.equivalence_generated
+        self.seed = args.equivalence_seed
+        self.recorded = [data_dir for data_dir in (args.equivalence_cases or '').split(',') if data_dir]
+        self.output_dir = args.equivalence_output
+        self.account_mapping = args.account_mapping
+        self.workers = args.workers or os.cpu_count() or 1
+        self.cache = LegacyCache(self.output_dir, legacy_fingerprint(self.account_mapping)) if args.equivalence_cache else None
+        self.failures = []
+        self.unreadable = []
+
+        # Fail fast on a bad candidate rather than in every worker
+        load_translator(self.candidate)
+        check_comparison()
+
+    def build_tasks(self):
+        tasks = [{'seed': self.seed + offset} for offset in range(self.generated)]
+        tasks += find_recorded_cases(self.recorded)
+        return [tasks[start:start + CASES_PER_TASK] for start in range(0, len(tasks), CASES_PER_TASK)]
+
+    def run(self):
+        '''
+        Run every case across the worker pool and save each minimized failure. Returns True if every case matched
+        '''
+        started = time.monotonic()
+        batches = self.build_tasks()
+        cases = 0
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(run_cases, batch, LEGACY_TRANSLATOR, self.candidate, self.account_mapping, self.cache)
+                       for batch in batches]
+            for future in futures:
+                batch_cases, failures, unreadable = future.result()
+                cases += batch_cases
+                self.unreadable += unreadable
+                for failure in failures:
+                    self.save_failure(failure)
+        elapsed = time.monotonic() - started
+
+        rate = cases / elapsed * 60 if elapsed else 0
+        print(f"\n✅ Finished! Compared {self.candidate} with the legacy translator on {cases} cases "
+              f"in {elapsed:.1f}s ({rate:.0f} cases/min)")
+        for case in self.unreadable:
+            print(f"⚠️ {case['name']}: unreadable amounts on {case['legacy']} legacy and {case['candidate']} candidate lines")
+        for failure in self.failures:
+            print(f"❌ {failure['name']}: {failure['difference']}")
+        if self.failures:
+            print(f"Minimized inputs for the {len(self.failures)} failing cases are in {self.store.directory}")
+        return not self.failures
+
+    @property
+    def store(self):
+        return IntermediateStore(self.output_dir)
+
+    def save_failure(self, failure):
+        '''
+        Save the minimized input as a recorded case, so the output dir can be passed back in with --equivalence-cases
+        '''
+        name = f"failure-{failure['name']}"
+        self.store.write(name, 'transactions', failure['transactions'])
+        self.store.write(name, 'deposits', failure['deposits'])
+        logging.error(f"{failure['name']} differs: {failure['difference']}. Minimized to {len(failure['transactions'])} "
+                      f"transactions and {len(failure['deposits'])} deposits: {failure['minimized_difference']}")
+        self.failures.append(failure)
@@ -1,15 +1,22 @@
 import platform
+import json
 import os
 import logging
 import subprocess
 
 from crontab import CronTab
 
+CRON_COMMENT = 'dollar-mountain-scheduler'
+# What older installs scheduled directly, one entry per job and run time. The scheduler runs these now
+LEGACY_CRON_SCRIPTS = ['autorun/chow_now_auto.sh', 'autorun/data_from_journal_auto.sh']
+LEGACY_TASKS = ['Chownow', 'Vagaro']
+
 class Installer:
 
-    def __init__(self, reinstall=None):
+    def __init__(self, reinstall=None, scheduler_config='scheduler.json'):
         self.os = platform.system()
         self.reinstall = reinstall
+        self.scheduler_config = scheduler_config
         self.working_directory = os.getcwd()
 
     def install(self):
@@ -31,6 +38,7 @@ class Installer:
             pass # Write file, but it's contents are empty
 
         self.build_inputs()
+        self.write_scheduler_config()
 
         if self.os and self.os == 'Windows':
             self.build_task_scheduler_jobs()
@@ -72,39 +80,51 @@ class Installer:
         # Add any other scripts here in the same pattern
         return
 
+    def write_scheduler_config(self):
+        '''
+        The built in scheduler (see job_scheduler.py) reads the run times and scripts from here
+        '''
+        sources = []
+        if self.run_chow_now == 'y':
+            sources.append('chownow')
+        if self.run_journals == 'y':
+            sources.append('vagaro')
+
+        with open(self.scheduler_config, 'w') as f:
+            json.dump({'run_times': self.run_times, 'sources': sources}, f, indent=4)
+
     def build_cronjobs(self):
         '''
         On linux systems, create a cronjob in the crontab using crontab library
         This defaults to running on the current user
         This also comes with logging out of the box using the existing log file directory provided in the repo
 
+        Only a single entry is added: it starts the built in scheduler, which runs the jobs at the configured times
+        It fires every 15 minutes as a watchdog, if the scheduler is already running the new one just exits
+        Any per job entries from an older install are removed, otherwise they would keep running alongside it
+
         NOTE: This comes with the ability to edit the cronfile out of the box by chmodding the crontab
         If you don not want this, comment this section out
         '''
         subprocess.call(['sudo chmod 2755 /usr/bin/crontab'], shell=True)
 
         cron = CronTab(user=True)
+        cron.remove_all(comment=CRON_COMMENT)
+        for script in LEGACY_CRON_SCRIPTS:
+            cron.remove(*cron.find_command(script))
 
-        for run_time in self.run_times:
-            if self.run_chow_now:
-                job = cron.new(command=f'{self.working_directory}/autorun/chow_now_auto.sh >> {self.working_directory}/../logs/chow_now_auto.log 2>&1')
-                job.minute.on(0)
-                job.hour.on(run_time)
-
-            if self.run_journals:
-                # This job requires a date argument, but cron can except the current date as an argument
-                job = cron.new(command=f'{self.working_directory}/autorun/data_from_journal_auto.sh $(date +%Y%m%d) >> {self.working_directory}/../logs/journal_auto.log 2>&1')
-                job.minute.on(0)
-                job.hour.on(run_time)
+        job = cron.new(command=f'{self.working_directory}/autorun/scheduler_auto.sh >> {self.working_directory}/../logs/scheduler.log 2>&1', comment=CRON_COMMENT)
+        job.minute.every(15)
         cron.write()
 
     def build_task_scheduler_jobs(self):
         '''
         For windows, add the jobs to task scheduler as cron doesn't exist there
         There are some painful to use libraries, but we can also just run a command here
+
+        As with cron, this is a single task that keeps the built in scheduler running, and the tasks an older
+        install made are deleted (it's fine if they don't exist)
         '''
-        for run_time in self.run_times:
-            if self.run_chow_now:
-                os.system(rf'SchTasks /Create /SC DAILY /TN "Chownow" /TR "{self.working_directory}/autorun/chow_now.bat" /ST {run_time}:00')
-            if self.run_journals:
-                os.system(rf'SchTasks /Create /SC DAILY /TN "Vagaro" /TR "{self.working_directory}/autorun/data_from_journal.bat $(date +%Y%m%d)" /ST {run_time}:00')
+        for task in LEGACY_TASKS:
+            os.system(rf'SchTasks /Delete /F /TN "{task}" >NUL 2>&1')
+        os.system(rf'SchTasks /Create /F /SC MINUTE /MO 15 /TN "DollarMountainScheduler" /TR "{self.working_directory}/autorun/scheduler.bat"')
@@ -0,0 +1,80 @@
+'''
+Arrow IPC copies of the normalized TL/DR reports
+
+Every run of the journal job for a date used to parse the excel reports again. Instead, the normalized transactions
+and deposits for a date are written once as arrow files under <data dir>/intermediate/, and later runs for that date
+(and the equivalence check) memory map them. Parallel workers reading the same file share one copy of it
+'''
+import logging
+import os
+
+from output_writer import OutputWriter, arrow_table_from_frame
+
+DATASETS = ['transactions', 'deposits']
+
+
+def read_arrow_table(file_path, columns=None):
+    '''
+    Memory map an arrow IPC file and return it as an arrow table. Nothing is copied until a column is actually used
+    '''
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise Exception("Reading arrow files requires pyarrow. Install it with pip install pyarrow")
+
+    table = pa.ipc.open_file(pa.memory_map(file_path, 'r')).read_all()
+    return table.select(columns) if columns else table
+
+
+def read_arrow_frame(file_path, columns=None, writable=False):
+    '''
+    Memory map an arrow IPC file into a dataframe. With split_blocks, numeric columns without nulls point straight at the
+    mapped file instead of being copied into one consolidated block. Those columns are read only
+
+    :param writable: Copy the data into regular pandas blocks, for stages that edit the frame in place
+    '''
+    table = read_arrow_table(file_path, columns=columns)
+    return table.to_pandas() if writable else table.to_pandas(split_blocks=True)
+
+
+class IntermediateStore:
+
+    def __init__(self, data_dir):
+        self.directory = os.path.join(data_dir, 'intermediate')
+
+    def path(self, date, dataset):
+        if dataset not in DATASETS:
+            raise Exception(f"Unknown intermediate dataset {dataset}. Must be one of {DATASETS}")
+        return os.path.join(self.directory, f'{date}-{dataset}.arrow')
+
+    def is_fresh(self, date, dataset, source_file=None):
+        '''
+        An intermediate is only used if it exists and is at least as new as the file it was built from
+        '''
+        path = self.path(date, dataset)
+        if not os.path.exists(path):
+            return False
+        return source_file is None or os.path.getmtime(path) >= os.path.getmtime(source_file)
+
+    def read(self, date, dataset, columns=None, writable=False):
+        return read_arrow_frame(self.path(date, dataset), columns=columns, writable=writable)
+
+    def write(self, date, dataset, df, lossless=False):
+        '''
+        Write a dataset atomically. With lossless, a frame whose columns can't be stored exactly is not written at all
+        (the stage just falls back to its original inputs next time) rather than cached with changed types
+
+        It's written in one batch, so it keeps its exact types rather than the writer's widened ones
+        '''
+        try:
+            schema = arrow_table_from_frame(df, lossless=lossless).schema
+        except Exception as e:
+            if not lossless:
+                raise
+            logging.warning(f'Not caching {dataset} for {date} as arrow: {e}')
+            return None
+
+        path = self.path(date, dataset)
+        with OutputWriter(path, columns=df.columns, schema=schema) as writer:
+            writer.write_batch(df)
+        return path
@@ -0,0 +1,229 @@
+'''
+A built in scheduler that replaces one cron/task scheduler entry per hour per script
+
+Jobs are kept in a small sqlite queue keyed on (tenant, source, date), so asking for a job that is already queued or
+running coalesces into the existing run rather than starting an overlapping one. Heavy jobs run on the tenant runner's
+shared pool, capped at max_concurrent_jobs. On startup any dates missed since the last successful run (the machine was
+asleep or off) are queued and backfilled in parallel
+'''
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from datetime import datetime, timedelta
+
+from tenant_runner import SOURCES, Tenant, TenantRunner, load_tenants
+
+DEFAULT_CONFIG = {
+    'run_times': ['01'],
+    'sources': ['chownow', 'vagaro'],
+    'tenants': None,
+    'data_dir': '../data/',
+    'max_concurrent_jobs': 2,
+    'catch_up_days': 7,
+    'poll_seconds': 60,
+    'database': 'scheduler.db',
+}
+
+
+def acquire_instance_lock(lock_file):
+    '''
+    Take an OS level lock so only one scheduler runs at a time. The OS drops the lock if the process dies, so a crashed
+    scheduler never blocks the next one. Returns None if another scheduler already holds it
+    '''
+    handle = open(lock_file, 'a+')
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return None
+    return handle
+
+
+def to_date(date):
+    return datetime.strptime(str(date), '%Y%m%d').date()
+
+
+def from_date(date):
+    return int(date.strftime('%Y%m%d'))
+
+
+class JobQueue:
+
+    def __init__(self, database):
+        '''
+        The persistent job queue. Every (tenant, source, date) has exactly one row, which is what coalesces duplicates
+        '''
+        self.connection = sqlite3.connect(database)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                tenant TEXT NOT NULL,
+                source TEXT NOT NULL,
+                date INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (tenant, source, date)
+            )
+        ''')
+        self.connection.commit()
+
+    def enqueue(self, tenant, source, date):
+        '''
+        Queue a run. If the job is already queued or running for that date this is a no-op, otherwise a finished or
+        failed job is queued to run again
+        '''
+        with self.connection:
+            cursor = self.connection.execute('''
+                INSERT INTO jobs (tenant, source, date, status, updated_at) VALUES (?, ?, ?, 'queued', ?)
+                ON CONFLICT (tenant, source, date) DO UPDATE SET status = 'queued', updated_at = excluded.updated_at
+                WHERE jobs.status NOT IN ('queued', 'running')
+            ''', (tenant, source, date, datetime.now().isoformat()))
+        return cursor.rowcount > 0
+
+    def claim_queued(self):
+        '''
+        Move every queued job to running and return them
+        '''
+        with self.connection:
+            rows = self.connection.execute(
+                "SELECT tenant, source, date FROM jobs WHERE status = 'queued' ORDER BY date, tenant, source"
+            ).fetchall()
+            self.connection.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE status = 'queued'",
+                (datetime.now().isoformat(),)
+            )
+        return [{'tenant': tenant, 'source': source, 'date': date} for tenant, source, date in rows]
+
+    def finish(self, result):
+        with self.connection:
+            self.connection.execute(
+                'UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE tenant = ? AND source = ? AND date = ?',
+                ('done' if result['status'] == 'ok' else 'failed', result['error'], datetime.now().isoformat(),
+                 result['tenant'], result['source'], result['date'])
+            )
+
+    def requeue_interrupted(self):
+        '''
+        Anything still marked running when we start was interrupted by a crash or shutdown, so it needs to run again
+        '''
+        with self.connection:
+            self.connection.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+
+    def last_done_date(self, tenant, source):
+        row = self.connection.execute(
+            "SELECT MAX(date) FROM jobs WHERE tenant = ? AND source = ? AND status = 'done'", (tenant, source)
+        ).fetchone()
+        return row[0]
+
+
+class JobScheduler:
+
+    def __init__(self, args):
+        '''
+        Create the scheduler from the scheduler config written by the installer (see --scheduler-config)
+        '''
+        self.config = dict(DEFAULT_CONFIG)
+        if os.path.exists(args.scheduler_config):
+            with open(args.scheduler_config) as f:
+                self.config.update(json.load(f))
+        else:
+            logging.warning(f'No scheduler config found at {args.scheduler_config}, using the defaults')
+
+        self.run_hours = sorted(int(run_time) for run_time in self.config['run_times'])
+        if not self.run_hours:
+            raise Exception(f"The scheduler needs at least one run time in {args.scheduler_config}")
+        self.tenants = self.load_tenants()
+        self.runner = TenantRunner(self.tenants, args, workers=self.config['max_concurrent_jobs'],
+                                   max_jobs_per_tenant=args.max_jobs_per_tenant)
+        self.queue = JobQueue(self.config['database'])
+        self.lock_file = f"{self.config['database']}.lock"
+        self.last_tick = datetime.now()
+
+    def load_tenants(self):
+        '''
+        Use the tenants file if there is one, otherwise treat this install as a single business
+        '''
+        if self.config['tenants']:
+            return load_tenants(self.config['tenants'])
+        sources = [source for source in self.config['sources'] if source in SOURCES]
+        return [Tenant({'name': 'default', 'data_dir': self.config['data_dir'], 'sources': sources})]
+
+    def enqueue_date(self, date):
+        queued = 0
+        for tenant in self.tenants:
+            for job in tenant.build_jobs(date):
+                queued += self.queue.enqueue(job['tenant'], job['source'], job['date'])
+        return queued
+
+    def catch_up(self):
+        '''
+        Queue every date since each job's last successful run (at most catch_up_days back) whose first run time has
+        already passed. A job that has never run before just gets the latest of those dates
+
+        Today only counts once its first run time is here, anything later today is left to enqueue_due
+        '''
+        now = datetime.now()
+        latest = now.date() if now.hour >= self.run_hours[0] else now.date() - timedelta(days=1)
+        earliest = latest - timedelta(days=self.config['catch_up_days'])
+        queued = 0
+        for tenant in self.tenants:
+            for source in tenant.sources:
+                last_done = self.queue.last_done_date(tenant.name, source)
+                start = max(to_date(last_done) + timedelta(days=1), earliest) if last_done else latest
+                day = start
+                while day <= latest:
+                    queued += self.queue.enqueue(tenant.name, source, from_date(day))
+                    day += timedelta(days=1)
+        if queued:
+            logging.info(f'Queued {queued} missed jobs to catch up on')
+
+    def enqueue_due(self):
+        '''
+        Queue today's jobs if a run time has passed since the last check. A run time that passed while a long batch
+        was running still counts, it just coalesces with anything already queued
+        '''
+        now = datetime.now()
+        hour = self.last_tick.replace(minute=0, second=0, microsecond=0)
+        while hour <= now:
+            if hour > self.last_tick and hour.hour in self.run_hours:
+                self.enqueue_date(from_date(hour.date()))
+            hour += timedelta(hours=1)
+        self.last_tick = now
+
+    def run_queued(self):
+        jobs = self.queue.claim_queued()
+        if not jobs:
+            return 0
+        logging.info(f'Running {len(jobs)} jobs')
+        for result in self.runner.run(jobs):
+            self.queue.finish(result)
+        return len(jobs)
+
+    def run(self, once=False):
+        '''
+        Run the scheduler until stopped. With once, only catch up and run anything queued, then exit
+        '''
+        lock = acquire_instance_lock(self.lock_file)
+        if lock is None:
+            logging.info('Another scheduler is already running, exiting')
+            return
+
+        try:
+            self.queue.requeue_interrupted()
+            self.catch_up()
+            self.run_queued()
+            while not once:
+                self.enqueue_due()
+                if not self.run_queued():
+                    time.sleep(self.config['poll_seconds'])
+        finally:
+            lock.close()
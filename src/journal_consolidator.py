@@ -0,0 +1,238 @@
+'''
+Combines the ChowNow, Vagaro and SpotOn journal outputs into a single Quickbooks import file per period
+
+Every per-source file is mapped onto one set of columns and streamed through a heap based k-way merge ordered by
+journal date and journal number. Files are only opened once the merge reaches their first date and are read a chunk at a
+time, so memory stays flat no matter how many years of daily files go in. The arrow copy of each file's lines that its
+job kept is memory mapped when there is one, rather than parsing the csv
+'''
+import pandas as pd
+import glob
+import heapq
+import logging
+import os
+
+from dates import date_keys, format_date_key, parse_dates
+from journal_schema import (cents_to_currency, has_fresh_journal_lines, read_journal_file, read_journal_lines,
+                            resolve_columns)
+from output_writer import OutputWriter
+
+# The unified columns the merge is ordered on
+KEY_COLUMNS = ['journal_date', 'journal_number']
+# Every source writes its dates a little differently (7/1/2025 or 07/01/2025), so they're all written out the same way
+DATE_FORMAT = '%m/%d/%Y'
+CONSOLIDATED_COLUMNS = ['Journal Date', 'Journal Number', 'Source', 'Account', 'Memo', 'Payee', 'Debits', 'Credits']
+# Period -> (divisor of the yyyymmdd date key, how the period is written in the file name)
+PERIODS = {
+    'day': (1, '{:08d}'),
+    'month': (100, '{:06d}'),
+    'year': (10000, '{:04d}'),
+}
+
+
+def parse_inputs(inputs):
+    '''
+    Parse --consolidate-inputs, a comma separated list of source=glob pairs, into (source, file) pairs
+    '''
+    files = {}
+    for spec in inputs.split(','):
+        if '=' not in spec:
+            raise Exception(f"Consolidation inputs must look like source=pattern. Given {spec}")
+        source, pattern = [part.strip() for part in spec.split('=', 1)]
+        for file in sorted(glob.glob(pattern)):
+            files.setdefault(file, source)
+    return [(source, file) for file, source in files.items()]
+
+
+class JournalStream:
+
+    def __init__(self, source, file_path, chunksize):
+        '''
+        One per-source journal file, read in chunks and yielded line by line in (date, journal number) order
+        '''
+        self.source = source
+        self.file_path = file_path
+        self.chunksize = chunksize
+        self.first_key, self.is_sorted = self.scan()
+
+    def chunk_keys(self, chunk):
+        '''
+        The (yyyymmdd date, journal number) sort key of every line in a raw or normalized chunk, NA where the date
+        can't be read
+        '''
+        resolved = dict(resolve_columns(chunk.columns), **{column: column for column in KEY_COLUMNS if column in chunk})
+        if 'journal_date' not in resolved or 'journal_number' not in resolved:
+            raise Exception(f"{self.file_path} doesn't have a journal date and journal number column to merge on")
+        number_column = chunk[resolved['journal_number']]
+        dates = parse_dates(chunk[resolved['journal_date']], '%m/%d/%Y')
+        numbers = number_column.astype(object).where(number_column.notna(), '').astype(str).str.strip()
+        return date_keys(dates), numbers
+
+    def keyed_chunks(self):
+        '''
+        Normalize each chunk and add its sort key. Lines with a date we can't read are logged and left out
+        '''
+        for lines in read_journal_lines(self.file_path, chunksize=self.chunksize):
+            date_keys, _ = self.chunk_keys(lines)
+            if date_keys.isna().any():
+                logging.error(f"Skipping {date_keys.isna().sum()} lines with a bad journal date in {self.file_path}")
+                lines, date_keys = lines[date_keys.notna()], date_keys[date_keys.notna()]
+            yield lines.assign(date_key=date_keys.astype('int64'))
+
+    def scan(self):
+        '''
+        Find the smallest key and check the file is already in order, a chunk at a time. Only the key columns are read
+
+        The heap places a file by its smallest key, not its first line, so a file that is out of order still opens
+        before the merge passes any of its dates
+        '''
+        first_key = previous_key = None
+        is_sorted = True
+        if has_fresh_journal_lines(self.file_path):
+            chunks = read_journal_lines(self.file_path, chunksize=self.chunksize, columns=KEY_COLUMNS)
+        else:
+            chunks = read_journal_file(self.file_path, chunksize=self.chunksize)
+        for chunk in chunks:
+            date_keys, numbers = self.chunk_keys(chunk)
+            valid = date_keys.notna()
+            keys = list(zip(date_keys[valid].astype('int64'), numbers[valid]))
+            if not keys:
+                continue
+            if first_key is None or min(keys) < first_key:
+                first_key = min(keys)
+            if previous_key is not None and keys[0] < previous_key:
+                is_sorted = False
+            if any(keys[index + 1] < keys[index] for index in range(len(keys) - 1)):
+                is_sorted = False
+            previous_key = keys[-1]
+        return first_key, is_sorted
+
+    def __iter__(self):
+        '''
+        Yield (key, line) pairs. A file that is out of order is sorted in memory, which only costs that one file
+
+        The journal date is written from the parsed date rather than as the source wrote it
+        '''
+        chunks = self.keyed_chunks()
+        if not self.is_sorted:
+            logging.warning(f"{self.file_path} is not in journal date order, sorting it in memory")
+            chunks = [pd.concat(list(chunks)).sort_values(['date_key', 'journal_number'], kind='mergesort')]
+
+        for lines in chunks:
+            for line in lines.itertuples(index=False):
+                yield (line.date_key, line.journal_number), (
+                    format_date_key(line.date_key, DATE_FORMAT), line.journal_number, self.source, line.account, line.memo, line.payee,
+                    line.debit_cents, line.credit_cents,
+                )
+
+
+class JournalConsolidator:
+
+    def __init__(self, args):
+        '''
+        Create the consolidator from the argument list passed in
+
+        See args.py or --help for documentation on the args
+        '''
+        self.inputs = parse_inputs(args.consolidate_inputs)
+        self.period = args.consolidate_period
+        self.output_dir = args.consolidate_output_dir
+        self.output_format = args.consolidate_format
+        self.batch_size = args.batch_size
+        self.intermediate = args.intermediate
+        self.output_files = []
+
+        if self.period not in PERIODS:
+            raise Exception(f"The consolidation period must be one of {list(PERIODS)}. Given {self.period}")
+        if not self.inputs:
+            raise Exception(f"No journal files matched {args.consolidate_inputs}")
+
+    def merge(self):
+        '''
+        K-way merge of every input by (journal date, journal number)
+
+        Unopened files sit in the heap keyed on their smallest key, so a file is only opened (and holds a chunk in memory)
+        once the merge actually reaches its dates. Ties keep the order the inputs were given in
+
+        A journal (source, journal number and date) found in more than one file would be booked twice, so that raises
+        '''
+        heap = []
+        for order, (source, file_path) in enumerate(self.inputs):
+            stream = JournalStream(source, file_path, self.batch_size)
+            if stream.first_key is not None:
+                heap.append((stream.first_key, order, 0, None, stream, None))
+        heapq.heapify(heap)
+
+        # The file each journal of the current date came from. Lines come out in date order, so older dates can go
+        journal_files = {}
+        current_date = None
+        while heap:
+            key, order, position, line, stream, iterator = heapq.heappop(heap)
+            if line is None:
+                # First time we reach this file, open it
+                iterator = iter(stream)
+            else:
+                if key[0] != current_date:
+                    journal_files, current_date = {}, key[0]
+                first_file = journal_files.setdefault((stream.source, key[1]), stream.file_path)
+                if first_file != stream.file_path:
+                    raise Exception(
+                        f"{stream.source} journal {key[1]} dated {key[0]} is in both {first_file} and {stream.file_path}, "
+                        "consolidating would book it twice"
+                    )
+                yield key, line
+            next_line = next(iterator, None)
+            if next_line is not None:
+                next_key, next_row = next_line
+                heapq.heappush(heap, (next_key, order, position + 1, next_row, stream, iterator))
+
+    def period_of(self, key):
+        divisor, name_format = PERIODS[self.period]
+        return name_format.format(key[0] // divisor)
+
+    def consolidate(self):
+        '''
+        Write one import file per period from the merged stream, a batch at a time
+        '''
+        writer = None
+        current_period = None
+        written_periods = set()
+        batch = []
+        try:
+            for key, line in self.merge():
+                period = self.period_of(key)
+                if period != current_period:
+                    if period in written_periods:
+                        # Opening it again would replace the file already written for the period
+                        raise Exception(f"Journal lines for {period} came out of order, refusing to overwrite its consolidated file")
+                    written_periods.add(period)
+                    self.flush(writer, batch)
+                    batch = []
+                    if writer:
+                        writer.close()
+                    current_period = period
+                    output_file = os.path.join(self.output_dir, f'consolidated-{period}.{self.output_format}')
+                    writer = OutputWriter(output_file, columns=CONSOLIDATED_COLUMNS, journal_lines=self.intermediate)
+                    self.output_files.append(output_file)
+                batch.append(line)
+                if len(batch) >= self.batch_size:
+                    self.flush(writer, batch)
+                    batch = []
+            self.flush(writer, batch)
+            if writer:
+                writer.close()
+        except Exception:
+            if writer:
+                writer.abort()
+            raise
+
+        print(f"\n✅ Finished! Consolidated {len(self.inputs)} journal files into {len(self.output_files)} files in {self.output_dir}")
+        return self.output_files
+
+    def flush(self, writer, batch):
+        if not batch:
+            return
+        frame = pd.DataFrame(batch, columns=CONSOLIDATED_COLUMNS)
+        frame['Debits'] = cents_to_currency(frame['Debits']).to_numpy()
+        frame['Credits'] = cents_to_currency(frame['Credits']).to_numpy()
+        writer.write_batch(frame)
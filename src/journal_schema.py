@@ -0,0 +1,162 @@
+'''
+Every job writes journal lines with its own column names (ChowNow, Vagaro and SpotOn all differ)
+This maps any of those outputs onto one set of columns so later stages only deal with a single format
+
+Jobs also keep their lines in that format as an arrow file in an intermediate folder next to the output (see
+OutputWriter's journal_lines), so upload and consolidation memory map them rather than parsing the csv and its money
+again
+'''
+import pandas as pd
+import numpy as np
+import os
+
+from intermediate_store import read_arrow_frame
+
+# Unified column name -> every column name the jobs are known to write for it
+COLUMN_ALIASES = {
+    'journal_date': ['Journal Date', 'Date'],
+    'journal_number': ['Journal Number', 'Journal No.', 'Journal No'],
+    'account': ['Account', 'Account Name'],
+    'memo': ['Memo', 'Description'],
+    'payee': ['Payee', 'Received From'],
+    'debits': ['Debits', 'Debit'],
+    'credits': ['Credits', 'Credit'],
+    # Only the consolidated files say which job a line came from, it's blank for everything else
+    'source': ['Source'],
+}
+UNIFIED_COLUMNS = ['journal_date', 'journal_number', 'account', 'memo', 'payee', 'source', 'debit_cents', 'credit_cents']
+CENTS_COLUMNS = ['debit_cents', 'credit_cents']
+
+
+def currency_to_cents(series):
+    '''
+    Convert a column of money (floats, "$1,234.50", "($12.00)", "-$3.5" or blanks) into whole cents
+    Blanks become 0 and anything that can't be read as money becomes <NA>
+    '''
+    if pd.api.types.is_numeric_dtype(series):
+        numbers = series.astype(float)
+    else:
+        text = series.astype(object).where(series.notna(), '').astype(str).str.strip()
+        negative = text.str.startswith('(') & text.str.endswith(')')
+        text = text.str.replace(r'[\$,()\s]', '', regex=True)
+        numbers = pd.to_numeric(text.replace('', '0'), errors='coerce')
+        numbers = numbers.where(~negative, -numbers)
+    numbers = numbers.where(series.notna(), 0)
+    return pd.Series(np.round(numbers.to_numpy(dtype=float) * 100), index=series.index).astype('Int64')
+
+
+def cents_to_currency(cents):
+    '''
+    Format whole cents back to a plain 2 decimal string for csv output. Zero is written as a blank
+    '''
+    cents = pd.Series(cents).fillna(0).astype('int64')
+    text = (cents.abs() // 100).astype(str) + '.' + (cents.abs() % 100).astype(str).str.zfill(2)
+    text = text.where(cents >= 0, '-' + text)
+    return text.where(cents != 0, '')
+
+
+def resolve_columns(columns):
+    '''
+    Work out which of the given column names feeds each unified column. Column names are matched ignoring
+    surrounding whitespace since the --journal-keys default leaves a leading space on most keys
+    '''
+    stripped = {str(column).strip(): column for column in columns}
+    resolved = {}
+    for unified, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in stripped:
+                resolved[unified] = stripped[alias]
+                break
+    return resolved
+
+
+def normalize_journal_frame(df):
+    '''
+    Map a job's journal dataframe onto UNIFIED_COLUMNS with money held as integer cents
+
+    :param df: The journal lines as written (or about to be written) by any of the jobs
+    '''
+    resolved = resolve_columns(df.columns)
+    normalized = pd.DataFrame(index=df.index)
+    for unified in ['journal_date', 'journal_number', 'account', 'memo', 'payee', 'source']:
+        if unified in resolved:
+            column = df[resolved[unified]]
+            normalized[unified] = column.astype(object).where(column.notna(), '').astype(str).str.strip()
+        else:
+            normalized[unified] = ''
+    for side in ['debits', 'credits']:
+        cents_column = side[:-1] + '_cents'
+        if side in resolved:
+            normalized[cents_column] = currency_to_cents(df[resolved[side]])
+        else:
+            normalized[cents_column] = pd.Series(0, index=df.index, dtype='Int64')
+    return normalized[UNIFIED_COLUMNS]
+
+
+def journal_lines_path(journal_file):
+    '''
+    Where the normalized arrow copy of a journal file lives: output.csv -> intermediate/output.csv.arrow
+    '''
+    directory, name = os.path.split(os.path.abspath(journal_file))
+    return os.path.join(directory, 'intermediate', f'{name}.arrow')
+
+
+def journal_lines_schema():
+    import pyarrow as pa
+    return pa.schema([(column, pa.int64() if column in CENTS_COLUMNS else pa.string()) for column in UNIFIED_COLUMNS])
+
+
+def has_fresh_journal_lines(journal_file):
+    '''
+    The arrow copy is only used if it was written after the journal file, so a file that was edited or rewritten
+    without one is always parsed again. A copy written with older columns is parsed again too
+    '''
+    path = journal_lines_path(journal_file)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(journal_file):
+        return False
+    import pyarrow as pa
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).schema.names == UNIFIED_COLUMNS
+
+
+def read_journal_lines(file_path, chunksize=None, columns=None):
+    '''
+    Load a journal file's lines as UNIFIED_COLUMNS. The arrow copy the job wrote is memory mapped when it's fresh,
+    otherwise the file itself is read and normalized
+
+    :param chunksize: If given, return an iterator of dataframes of at most this many rows
+    :param columns: Only these unified columns, which saves reading the rest from the arrow copy
+    '''
+    if has_fresh_journal_lines(file_path):
+        lines = read_arrow_frame(journal_lines_path(file_path), columns=columns)
+        for column in CENTS_COLUMNS:
+            if column in lines:
+                lines[column] = lines[column].astype('Int64')
+        if chunksize:
+            return (lines.iloc[start:start + chunksize] for start in range(0, len(lines), chunksize))
+        return lines
+
+    if chunksize:
+        return (normalize_journal_frame(chunk)[columns or UNIFIED_COLUMNS]
+                for chunk in read_journal_file(file_path, chunksize=chunksize))
+    return normalize_journal_frame(read_journal_file(file_path))[columns or UNIFIED_COLUMNS]
+
+
+def read_journal_file(file_path, chunksize=None):
+    '''
+    Load a journal file written by one of the jobs. Csv values are kept as text, exactly as written
+
+    :param chunksize: If given, return an iterator of dataframes of at most this many rows
+    '''
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == '.csv':
+        return pd.read_csv(file_path, dtype=str, keep_default_na=False, chunksize=chunksize)
+    elif extension in ['.parquet', '.arrow']:
+        if extension == '.arrow':
+            # Memory mapped, so chunks are just views over the file
+            df = read_arrow_frame(file_path)
+        else:
+            df = pd.read_parquet(file_path)
+        if chunksize:
+            return (df.iloc[start:start + chunksize] for start in range(0, len(df), chunksize))
+        return df
+    raise Exception(f"Unable to read journal file {file_path}. Only csv, parquet and arrow files are supported")
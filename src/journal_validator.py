@@ -0,0 +1,144 @@
+# This file checks journal lines balance before they are written, so Quickbooks never has to reject an import
+import pandas as pd
+import json
+import logging
+import os
+import time
+
+from journal_schema import normalize_journal_frame
+
+# Keep the report readable on huge backfills, the counts are always exact
+MAX_REPORTED_ISSUES = 1000
+LINE_CHECKS = ['missing_accounts', 'missing_journal_numbers', 'duplicate_lines', 'bad_amounts']
+
+class JournalValidator:
+
+    def __init__(self, source, strict=False):
+        '''
+        :param source: Name of the job the lines came from, included in the report
+        :param strict: Raise instead of just logging when the lines don't validate
+        '''
+        self.source = source
+        self.strict = strict
+        self.report = None
+
+    def validate(self, lines):
+        '''
+        Run every check over the journal lines in one vectorized pass and build the report
+        All money is compared in whole cents so float rounding can never hide (or invent) an imbalance
+
+        :param lines: Journal lines as a dataframe or list of row dictionaries, in any job's output columns
+        '''
+        self.report = self.check(lines)
+        self.log_summary()
+        return self.report
+
+    def check(self, lines):
+        '''
+        Build the report for the given lines without logging it
+        '''
+        started = time.monotonic()
+        frame = lines if isinstance(lines, pd.DataFrame) else pd.DataFrame(list(lines))
+        normalized = normalize_journal_frame(frame)
+
+        bad_amounts = normalized['debit_cents'].isna() | normalized['credit_cents'].isna()
+        missing_accounts = normalized['account'] == ''
+        missing_journal_numbers = normalized['journal_number'] == ''
+        # Only reported, never a failure: Vagaro writes one line per transaction, so two identical sales are two lines
+        duplicate_lines = normalized.duplicated(keep='first')
+
+        totals = normalized.groupby('journal_number', sort=False)[['debit_cents', 'credit_cents']].sum()
+        totals['difference_cents'] = totals['debit_cents'] - totals['credit_cents']
+        imbalanced = totals[totals['difference_cents'] != 0]
+
+        return {
+            'source': self.source,
+            'lines': len(normalized),
+            'journals': len(totals),
+            'valid': not (bad_amounts.any() or missing_accounts.any() or missing_journal_numbers.any() or len(imbalanced)),
+            'imbalanced_journals': self.summarize_journals(imbalanced),
+            'missing_accounts': self.summarize_lines(missing_accounts),
+            'missing_journal_numbers': self.summarize_lines(missing_journal_numbers),
+            'duplicate_lines': self.summarize_lines(duplicate_lines),
+            'bad_amounts': self.summarize_lines(bad_amounts),
+            'seconds': round(time.monotonic() - started, 3),
+        }
+
+    def validate_chunk(self, lines):
+        '''
+        Validate one chunk of a streamed output and add it to the running report. Line numbers carry on from the
+        previous chunks. Each check only looks within the chunk, so the caller has to keep every journal in one chunk
+        Call log_summary once the last chunk is in
+        '''
+        previous = self.report
+        report = self.check(lines)
+        if previous is None:
+            self.report = report
+            return self.report
+
+        offset = previous['lines']
+        combined = dict(previous, lines=offset + report['lines'], journals=previous['journals'] + report['journals'],
+                        valid=previous['valid'] and report['valid'], seconds=round(previous['seconds'] + report['seconds'], 3))
+        for key in LINE_CHECKS:
+            combined[key] = {
+                'count': previous[key]['count'] + report[key]['count'],
+                'lines': (previous[key]['lines'] + [line + offset for line in report[key]['lines']])[:MAX_REPORTED_ISSUES],
+            }
+        combined['imbalanced_journals'] = {
+            'count': previous['imbalanced_journals']['count'] + report['imbalanced_journals']['count'],
+            'journals': (previous['imbalanced_journals']['journals'] + report['imbalanced_journals']['journals'])[:MAX_REPORTED_ISSUES],
+        }
+        self.report = combined
+        return self.report
+
+    def summarize_lines(self, mask):
+        '''
+        Report line numbers as positions in the output (0 is the first journal line, not counting the header)
+        '''
+        positions = mask.to_numpy().nonzero()[0]
+        return {'count': len(positions), 'lines': positions[:MAX_REPORTED_ISSUES].tolist()}
+
+    def summarize_journals(self, imbalanced):
+        journals = [
+            {
+                'journal_number': journal_number,
+                'debit_cents': int(row.debit_cents),
+                'credit_cents': int(row.credit_cents),
+                'difference_cents': int(row.difference_cents),
+            }
+            for journal_number, row in imbalanced.head(MAX_REPORTED_ISSUES).iterrows()
+        ]
+        return {'count': len(imbalanced), 'journals': journals}
+
+    def log_summary(self):
+        report = self.report
+        if report['duplicate_lines']['count']:
+            logging.warning(f"{self.source}: {report['duplicate_lines']['count']} lines repeat an earlier line exactly, check they're real")
+        if report['valid']:
+            logging.info(f"{self.source}: {report['lines']} journal lines in {report['journals']} journals balance")
+            return
+        logging.error(
+            f"{self.source}: journal lines failed validation. "
+            f"{report['imbalanced_journals']['count']} imbalanced journals, "
+            f"{report['missing_accounts']['count']} lines missing an account, "
+            f"{report['missing_journal_numbers']['count']} lines missing a journal number, "
+            f"{report['bad_amounts']['count']} unreadable amounts"
+        )
+
+    def write_report(self, output_file):
+        '''
+        Write the report as json next to the output file (output.csv -> output.csv.validation.json)
+        Raises afterwards in strict mode so the bad output is never written
+        '''
+        report_file = f'{output_file}.validation.json'
+        try:
+            # The report can come before the output, so its folder may not be there yet on a first run
+            os.makedirs(os.path.dirname(os.path.abspath(report_file)), exist_ok=True)
+            with open(report_file, 'w') as f:
+                json.dump(self.report, f, indent=2)
+        except Exception as e:
+            logging.error(f'Unable to write the validation report {report_file}: {e}')
+
+        if self.strict and not self.report['valid']:
+            raise Exception(f"Journal lines for {output_file} failed validation, see {report_file}")
+        return report_file
@@ -0,0 +1,96 @@
+'''
+A local stand in for the Quickbooks batch API so the uploader can be tested offline
+
+It accepts the same batch requests as Quickbooks, remembers every request id it has seen so a replayed request is
+not applied twice, and can be told to throttle or fail a share of requests to exercise the retry handling
+'''
+import asyncio
+import logging
+import random
+
+class MockQuickBooksServer:
+
+    def __init__(self, port=8765, failure_rate=0.0, throttle_rate=0.0, latency=0.0, seed=None):
+        '''
+        :param failure_rate: Share of requests answered with a 503
+        :param throttle_rate: Share of requests answered with a 429 and a Retry-After header
+        :param latency: Seconds to wait before answering each request
+        '''
+        self.port = port
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.responses = {}
+        self.journal_entries = {}
+        self.stats = {'requests': 0, 'throttled': 0, 'failed': 0, 'replayed': 0, 'created': 0}
+
+    def build_app(self):
+        try:
+            from aiohttp import web
+        except ImportError:
+            raise Exception("The mock Quickbooks server requires aiohttp. Install it with pip install aiohttp")
+
+        app = web.Application()
+        app.router.add_post('/v3/company/{realm}/batch', self.handle_batch)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+    async def handle_batch(self, request):
+        from aiohttp import web
+
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        roll = self.random.random()
+        if roll < self.throttle_rate:
+            self.stats['throttled'] += 1
+            return web.json_response({'Fault': {'type': 'ThrottleExceeded'}}, status=429, headers={'Retry-After': '0.1'})
+        if roll < self.throttle_rate + self.failure_rate:
+            self.stats['failed'] += 1
+            return web.json_response({'Fault': {'type': 'ServiceUnavailable'}}, status=503)
+
+        request_id = request.query.get('requestid')
+        if request_id and request_id in self.responses:
+            self.stats['replayed'] += 1
+            return web.json_response(self.responses[request_id])
+
+        body = await request.json()
+        items = []
+        for item in body.get('BatchItemRequest', []):
+            items.append(self.create_journal_entry(request.match_info['realm'], item))
+        response = {'BatchItemResponse': items}
+        if request_id:
+            self.responses[request_id] = response
+        return web.json_response(response)
+
+    def create_journal_entry(self, realm, item):
+        '''
+        Apply the same checks Quickbooks does on a journal entry: lines must be present and debits must equal credits
+        '''
+        entry = item.get('JournalEntry', {})
+        lines = entry.get('Line', [])
+        totals = {'Debit': 0, 'Credit': 0}
+        for line in lines:
+            totals[line['JournalEntryLineDetail']['PostingType']] += round(line['Amount'] * 100)
+
+        if not lines or totals['Debit'] != totals['Credit']:
+            return {'bId': item.get('bId'), 'Fault': {'type': 'ValidationFault', 'Error': [{
+                'Message': 'Transaction is not balanced', 'Detail': f"Debits {totals['Debit']} != credits {totals['Credit']}",
+            }]}}
+
+        key = (realm, item.get('bId'))
+        if key not in self.journal_entries:
+            self.stats['created'] += 1
+            self.journal_entries[key] = dict(entry, Id=str(len(self.journal_entries) + 1))
+        return {'bId': item.get('bId'), 'JournalEntry': self.journal_entries[key]}
+
+    async def handle_stats(self, request):
+        from aiohttp import web
+        return web.json_response(self.stats)
+
+    def serve(self):
+        from aiohttp import web
+        logging.info(f'Mock Quickbooks server listening on http://localhost:{self.port}')
+        web.run_app(self.build_app(), host='localhost', port=self.port)
@@ -0,0 +1,274 @@
+# This file streams journal lines out to disk in batches so we never need the whole output in memory
+import pandas as pd
+import logging
+import os
+import tempfile
+import time
+
+SUPPORTED_FORMATS = ['.csv', '.parquet', '.arrow']
+
+class OutputWriter:
+
+    def __init__(self, output_file, columns=None, schema=None, journal_lines=False):
+        '''
+        Create a writer for the given output file. The format is picked from the file extension
+
+        Everything is written to a temp file next to the target and only renamed over the target on close
+        This means a crash mid-write leaves the previous file (or nothing) behind, never a truncated import file
+
+        :param output_file: The final path to write to (.csv, .parquet or .arrow)
+        :param columns: Optional column order. If not given, the columns of the first batch are used
+        :param schema: Optional arrow schema for .arrow output. If not given, it's worked out from the first batch
+        :param journal_lines: The output is journal lines. Also keep them normalized as arrow (see journal_schema), so
+            later stages memory map those instead of parsing the output again. Requires pyarrow
+        '''
+        self.output_file = output_file
+        self.format = os.path.splitext(output_file)[1].lower()
+        self.columns = list(columns) if columns is not None else None
+        self.schema = schema
+        self.journal_lines = journal_lines
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.elapsed = 0
+
+        if self.format not in SUPPORTED_FORMATS:
+            raise Exception(f"The output file must be one of {SUPPORTED_FORMATS}. Given {output_file}")
+
+        self._handle = None
+        self._parquet_writer = None
+        self._arrow_writer = None
+        self._arrow_schema = None
+        self._lines_writer = None
+        self._temp_file = None
+        self._header_written = False
+        self._started = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def open(self):
+        '''
+        Create the temp file in the same directory as the target so the final rename is atomic
+        '''
+        if self._temp_file:
+            return
+        directory = os.path.dirname(os.path.abspath(self.output_file))
+        os.makedirs(directory, exist_ok=True)
+        fd, self._temp_file = tempfile.mkstemp(
+            dir=directory, prefix=f'.{os.path.basename(self.output_file)}.', suffix='.tmp'
+        )
+        os.close(fd)
+        # mkstemp creates the file private to us, match the permissions a normal open() would give
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self._temp_file, 0o666 & ~umask)
+        self._started = time.monotonic()
+
+        if self.format == '.csv':
+            self._handle = open(self._temp_file, 'w', newline='', encoding='utf-8')
+        if self.journal_lines:
+            # Imported here since journal_schema reads arrow files through a module that imports this one
+            from journal_schema import UNIFIED_COLUMNS, journal_lines_path, journal_lines_schema
+            self._lines_writer = OutputWriter(journal_lines_path(self.output_file), columns=UNIFIED_COLUMNS,
+                                              schema=journal_lines_schema())
+
+    def write_batch(self, rows):
+        '''
+        Append a batch of journal lines to the output
+
+        :param rows: Either a dataframe or a list of row dictionaries
+        '''
+        frame = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(list(rows))
+        if frame.empty and self.columns is not None:
+            return
+
+        self.open()
+        if self.columns is None:
+            self.columns = frame.columns.tolist()
+        else:
+            extra_columns = [column for column in frame.columns if column not in self.columns]
+            if extra_columns:
+                raise Exception(f"Batch has columns {extra_columns} that are not in the output columns {self.columns}")
+        frame = frame.reindex(columns=self.columns)
+
+        if self.format == '.csv':
+            frame.to_csv(self._handle, header=not self._header_written, index=False)
+            self._header_written = True
+        elif self.format == '.arrow':
+            self._write_arrow_batch(frame)
+        else:
+            self._write_parquet_batch(frame)
+        if self._lines_writer:
+            from journal_schema import normalize_journal_frame
+            self._lines_writer.write_batch(normalize_journal_frame(frame))
+        self.rows_written += len(frame)
+
+    def _write_parquet_batch(self, frame):
+        '''
+        Parquet needs a fixed schema across row groups, but our money columns mix blanks and numbers
+        To keep the archive lossless and consistent with the csv, every column is stored as text
+        '''
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception("Writing parquet output requires pyarrow. Install it with pip install pyarrow")
+
+        frame = frame.astype(object).where(frame.notna(), '').astype(str)
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self._temp_file, table.schema)
+        self._parquet_writer.write_table(table)
+
+    def _write_arrow_batch(self, frame):
+        '''
+        Arrow IPC keeps real column types so later stages can memory map the file and read numbers without parsing
+        The schema is fixed by the first batch and every later batch is cast to it, so it's widened to types the later
+        batches can still fit in (see widen_arrow_schema)
+        '''
+        import pyarrow as pa
+
+        if self._arrow_writer is None:
+            self._arrow_schema = self.schema or widen_arrow_schema(arrow_table_from_frame(frame).schema)
+            self._arrow_writer = pa.ipc.new_file(self._temp_file, self._arrow_schema)
+        self._arrow_writer.write_table(arrow_table_from_frame(frame, schema=self._arrow_schema))
+
+    def close(self):
+        '''
+        Flush everything to disk and atomically move the temp file over the target
+        '''
+        if self._temp_file is None:
+            # Nothing was written, but we still want a (header only) file for the importer
+            self.open()
+        if self.format == '.csv' and not self._header_written and self.columns:
+            pd.DataFrame(columns=self.columns).to_csv(self._handle, index=False)
+
+        if self._handle:
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+            self._handle.close()
+        if self._parquet_writer:
+            self._parquet_writer.close()
+        elif self.format == '.parquet':
+            self._write_parquet_batch(pd.DataFrame(columns=self.columns or []))
+            self._parquet_writer.close()
+        if self._arrow_writer:
+            self._arrow_writer.close()
+        elif self.format == '.arrow':
+            self._write_arrow_batch(pd.DataFrame(columns=self.columns or []))
+            self._arrow_writer.close()
+        if self.format != '.csv':
+            # pyarrow opened and closed these files itself, so make sure they're on disk before the rename
+            with open(self._temp_file, 'rb+') as f:
+                os.fsync(f.fileno())
+
+        self.bytes_written = os.path.getsize(self._temp_file)
+        lines_writer = self._lines_writer
+        os.replace(self._temp_file, self.output_file)
+        if lines_writer:
+            # Finished after the output, so it's never older than the file it describes
+            lines_writer.close()
+        self.elapsed = time.monotonic() - self._started
+        self._reset()
+        self.report()
+
+    def abort(self):
+        '''
+        Throw away the partial temp file, leaving the previous output untouched
+        '''
+        if self._handle:
+            self._handle.close()
+        if self._parquet_writer:
+            self._parquet_writer.close()
+        if self._arrow_writer:
+            self._arrow_writer.close()
+        if self._lines_writer:
+            self._lines_writer.abort()
+        if self._temp_file and os.path.exists(self._temp_file):
+            os.remove(self._temp_file)
+        logging.error(f'Write to {self.output_file} aborted, the existing file was left untouched')
+        self._reset()
+
+    def _reset(self):
+        self._handle = None
+        self._parquet_writer = None
+        self._arrow_writer = None
+        self._arrow_schema = None
+        self._lines_writer = None
+        self._temp_file = None
+        self._header_written = False
+
+    def report(self):
+        '''
+        Print how much was written and how fast so it lands in the job logs
+        '''
+        elapsed = max(self.elapsed, 1e-9)
+        print(
+            f'Wrote {self.rows_written} rows ({self.bytes_written} bytes) to {self.output_file} in {self.elapsed:.3f}s '
+            f'({self.rows_written / elapsed:.0f} rows/s, {self.bytes_written / elapsed / 1e6:.2f} MB/s)'
+        )
+
+
+def widen_arrow_schema(schema):
+    '''
+    Widen a schema taken from one batch so the batches after it fit too: integers become floats (a later batch with a
+    blank or a decimal comes out of pandas as floats) and columns that were all blank become text
+    '''
+    import pyarrow as pa
+
+    fields = []
+    for field in schema:
+        if pa.types.is_integer(field.type):
+            field = field.with_type(pa.float64())
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    # The pandas metadata still describes the first batch's types, so it's left off
+    return pa.schema(fields)
+
+
+def arrow_table_from_frame(frame, schema=None, lossless=False):
+    '''
+    Convert a dataframe to an arrow table, keeping the real column types wherever arrow can hold them
+
+    Journal output mixes blanks and numbers in the money columns, which arrow can't store in one column
+    By default those columns are written as text (the same as the csv). With lossless, an exception is raised instead
+
+    :param schema: Cast to this schema, so every batch of a file has the same types
+    '''
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise Exception("Writing arrow files requires pyarrow. Install it with pip install pyarrow")
+
+    frame = frame.copy()
+    for column in frame.columns:
+        target = schema.field(str(column)).type if schema is not None else None
+        try:
+            pa.array(frame[column], type=target, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError, ValueError):
+            if lossless:
+                raise Exception(f"Column {column} has mixed types and can't be stored as arrow without changing it")
+            if target is not None and not pa.types.is_string(target):
+                raise Exception(f"Column {column} has values that don't fit the {target} type it was given in the first batch")
+            frame[column] = frame[column].astype(object).where(frame[column].notna(), None).map(
+                lambda value: value if value is None else str(value)
+            )
+    return pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+
+
+def write_frame(frame, output_file, batch_size=50000, journal_lines=False):
+    '''
+    Convenience helper to stream an existing dataframe out in batches through the writer
+    '''
+    with OutputWriter(output_file, columns=frame.columns, journal_lines=journal_lines) as writer:
+        for start in range(0, len(frame), batch_size):
+            writer.write_batch(frame.iloc[start:start + batch_size])
+    return writer
@@ -0,0 +1,175 @@
+'''
+Keeps track of every report row, cell or file a job had to reject, so one bad value doesn't mean rerunning everything
+
+Jobs record what they rejected (with the reason and where it is in the source file) and carry on with the rows that
+are fine. Each item also stores the job it came from, so once the report is fixed --reprocess-quarantine reruns only
+the jobs (a single date, not a whole backfill) that still have open items
+'''
+import argparse
+import json
+import logging
+import sqlite3
+
+from datetime import datetime
+
+# The args a job needs to be rerun later, on top of whatever the reprocess command itself is given
+JOB_ARGS = {
+    'chownow': ['file_path', 'output_file', 'journal_keys', 'account_mapping', 'accounts', 'stream', 'chunk_size'],
+    'vagaro': ['file_path', 'output_dir', 'journal_keys', 'account_mapping'],
+}
+
+
+def build_job(source, args):
+    '''
+    Describe the job that is running, from its args, so it can be rerun from the quarantine. A tenant job also keeps
+    its tenant, so it's rerun the way the tenant runner runs it
+    '''
+    job = {'source': source, 'date': args.date, 'args': {key: getattr(args, key, None) for key in JOB_ARGS[source]}}
+    if getattr(args, 'tenant', None):
+        job['tenant'] = args.tenant
+    return job
+
+
+class QuarantineStore:
+
+    def __init__(self, database, job):
+        '''
+        :param database: The sqlite file holding the quarantine, see --quarantine-db
+        :param job: The job anything recorded through this store belongs to, see build_job
+        '''
+        self.job = job
+        self.job_key = json.dumps(job, sort_keys=True)
+        self.connection = sqlite3.connect(database, timeout=30)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS quarantine (
+                job TEXT NOT NULL,
+                source TEXT NOT NULL,
+                date INTEGER NOT NULL,
+                file TEXT NOT NULL,
+                location TEXT NOT NULL,
+                reason TEXT NOT NULL,
+                row TEXT,
+                status TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (job, file, location, reason)
+            )
+        ''')
+        self.connection.commit()
+
+    def record(self, file, location, reason, row=None):
+        '''
+        Quarantine one rejected item. Recording the same item again (e.g. it is still broken when reprocessed) just
+        reopens it
+        '''
+        self.record_many([(file, location, reason, row)])
+
+    def record_many(self, items):
+        '''
+        :param items: (file, location, reason, row) tuples, where row is an optional dictionary of the rejected values
+        '''
+        now = datetime.now().isoformat()
+        with self.connection:
+            self.connection.executemany('''
+                INSERT INTO quarantine (job, source, date, file, location, reason, row, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 'open', ?)
+                ON CONFLICT (job, file, location, reason) DO UPDATE SET
+                    row = excluded.row, status = 'open', updated_at = excluded.updated_at
+            ''', [
+                (self.job_key, self.job['source'], self.job['date'], str(file), location, reason,
+                 json.dumps(row, default=str) if row is not None else None, now)
+                for file, location, reason, row in items
+            ])
+        for file, location, reason, _ in items[:10]:
+            logging.error(f"Quarantined {file} {location}: {reason}")
+        if len(items) > 10:
+            logging.error(f"Quarantined {len(items) - 10} more items from {items[0][0]}")
+
+    def record_rows(self, file, rows, reason, header_rows=0):
+        '''
+        Quarantine whole report rows. The location is the row number as shown in excel, so they're easy to find
+
+        :param rows: The rejected rows, still carrying their index from the loaded report
+        :param header_rows: Rows above the table's own header (e.g. skiprows), to get back to the sheet's row number
+        '''
+        self.record_many([
+            (file, f'row {index + header_rows + 2}', reason, row.to_dict()) for index, row in rows.iterrows()
+        ])
+
+
+def open_jobs(database):
+    '''
+    Every job that still has open quarantined items, with how many
+    '''
+    connection = sqlite3.connect(database, timeout=30)
+    rows = connection.execute(
+        "SELECT job, COUNT(*) FROM quarantine WHERE status = 'open' GROUP BY job ORDER BY date, source"
+    ).fetchall()
+    connection.close()
+    return [(json.loads(job), count) for job, count in rows]
+
+
+def rerun_job(job, base_args):
+    '''
+    Run a quarantined job again with the args it was first run with
+    '''
+    # Imported here since the jobs themselves import this module
+    from data_importer import DataImporter
+    from data_translator_from_journal import JournalDataImporter
+    from tenant_runner import run_tenant_job
+
+    if job.get('tenant'):
+        # Through the tenant runner, so the output is cut down to the job's date the same as the first run
+        tenant_job = {'tenant': job['tenant']['name'], 'source': job['source'], 'date': job['date']}
+        result = run_tenant_job(tenant_job, job['tenant'], dict(vars(base_args)))
+        if result['status'] != 'ok':
+            raise Exception(result['error'])
+        return
+
+    args = argparse.Namespace(**dict(vars(base_args), **job['args'], date=job['date']))
+    if job['source'] == 'chownow':
+        data_importer = DataImporter(args)
+        if args.stream:
+            data_importer.stream_output_file()
+        else:
+            data_importer.load_data()
+            data_importer.write_output_file()
+    else:
+        journal_data_importer = JournalDataImporter(args)
+        journal_data_importer.build_composite_dataframe()
+
+
+def reprocess_quarantine(base_args):
+    '''
+    Rerun every job with open quarantined items. Its items are resolved if the rerun succeeds, and anything that is
+    still broken is quarantined again by the rerun itself. Returns True if nothing is left open
+    '''
+    database = base_args.quarantine_db
+    jobs = open_jobs(database)
+    if not jobs:
+        print("\n✅ Finished! Nothing is quarantined")
+        return True
+
+    connection = sqlite3.connect(database, timeout=30)
+    for job, count in jobs:
+        job_key = json.dumps(job, sort_keys=True)
+        logging.info(f"Reprocessing {job['source']} {job['date']} for {count} quarantined items")
+        with connection:
+            connection.execute("UPDATE quarantine SET status = 'reprocessing' WHERE job = ? AND status = 'open'", (job_key,))
+        try:
+            rerun_job(job, base_args)
+            status = 'resolved'
+        except Exception as e:
+            logging.error(f"Reprocessing {job['source']} {job['date']} failed: {e}")
+            status = 'open'
+        with connection:
+            connection.execute(
+                "UPDATE quarantine SET status = ?, updated_at = ? WHERE job = ? AND status = 'reprocessing'",
+                (status, datetime.now().isoformat(), job_key)
+            )
+    connection.close()
+
+    remaining = open_jobs(database)
+    print(f"\n✅ Finished! Reprocessed {len(jobs)} jobs, {sum(count for _, count in remaining)} items are still quarantined")
+    for job, count in remaining:
+        print(f"❌ {job['source']} {job['date']}: {count} items")
+    return not remaining
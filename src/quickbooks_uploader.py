@@ -0,0 +1,200 @@
+# This file uploads the generated journal entries to Quickbooks using the batch API
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+
+from dates import format_dates, parse_dates
+from journal_schema import read_journal_lines
+
+# Quickbooks caps a single batch request at 30 operations
+MAX_BATCH_SIZE = 30
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+TOKEN_ENVIRONMENT_VARIABLE = 'QUICKBOOKS_ACCESS_TOKEN'
+
+class QuickBooksUploader:
+
+    def __init__(self, args):
+        '''
+        Create the uploader from the argument list passed in
+
+        The access token is read from the QUICKBOOKS_ACCESS_TOKEN environment variable so it never ends up in
+        the crontab, task scheduler or shell history
+        '''
+        self.base_url = args.quickbooks_url.rstrip('/')
+        self.realm = args.quickbooks_realm
+        self.batch_size = args.upload_batch_size
+        self.concurrency = args.upload_concurrency
+        self.max_retries = args.upload_retries
+        self.token = os.environ.get(TOKEN_ENVIRONMENT_VARIABLE, '')
+        self.account_ids = {}
+        self.results = {'uploaded': [], 'failed': {}}
+
+        if not self.realm:
+            raise Exception("A Quickbooks company id is required to upload. Pass it with --quickbooks-realm")
+        if self.batch_size < 1 or self.batch_size > MAX_BATCH_SIZE:
+            raise Exception(f"The upload batch size must be between 1 and {MAX_BATCH_SIZE}. Given {self.batch_size}")
+
+        if args.quickbooks_accounts:
+            with open(args.quickbooks_accounts) as f:
+                self.account_ids = json.load(f)
+
+    def load_entries(self, journal_file, source=None):
+        '''
+        Read a generated journal file and group its lines into one Quickbooks journal entry per source, journal number
+        and date. The job's arrow copy of the lines is used when there is one, so the csv and its money aren't parsed again
+
+        :param source: The job the file came from. Consolidated files say so on every line instead
+        '''
+        lines = read_journal_lines(journal_file)
+        lines['source'] = lines['source'].where(lines['source'] != '', source or '')
+        if (lines['source'] == '').any():
+            raise Exception(f"{journal_file} doesn't say which source its journals are from. Pass it with --upload-source")
+        lines['txn_date'] = format_dates(parse_dates(lines['journal_date'], '%m/%d/%Y'), '%Y-%m-%d')
+        lines['net_cents'] = (lines['debit_cents'].fillna(0) - lines['credit_cents'].fillna(0)).astype('int64')
+        lines = lines[lines['net_cents'] != 0]
+
+        entries = []
+        for (source, journal_number, _), group in lines.groupby(['source', 'journal_number', 'txn_date'], sort=False):
+            entries.append(self.build_journal_entry(source, journal_number, group))
+        logging.info(f'Loaded {len(entries)} journal entries from {journal_file}')
+        return entries
+
+    def build_journal_entry(self, source, journal_number, lines):
+        '''
+        Build the Quickbooks journal entry payload for a single journal number
+        Quickbooks wants positive amounts, so a negative debit is posted as a credit and vice versa
+        '''
+        payload_lines = []
+        for line in lines.itertuples(index=False):
+            account_ref = {'name': line.account}
+            if line.account in self.account_ids:
+                account_ref['value'] = str(self.account_ids[line.account])
+            payload_lines.append({
+                'Description': line.memo,
+                'Amount': abs(line.net_cents) / 100,
+                'DetailType': 'JournalEntryLineDetail',
+                'JournalEntryLineDetail': {
+                    'PostingType': 'Debit' if line.net_cents > 0 else 'Credit',
+                    'AccountRef': account_ref,
+                },
+            })
+        txn_date = lines['txn_date'].iloc[0] or None
+        return {
+            'bId': self.idempotency_key(source, journal_number, txn_date or ''),
+            'operation': 'create',
+            'JournalEntry': {
+                'DocNumber': journal_number,
+                'TxnDate': txn_date,
+                'Line': payload_lines,
+            },
+        }
+
+    def idempotency_key(self, *parts):
+        '''
+        Derive a stable key from the company and the given parts so a retried request is never applied twice
+
+        An entry is keyed on its source, journal number and date. Journal numbers alone aren't unique (ChowNow's have
+        no year and SpotOn's restart every report), and the lines are left out so a regenerated entry (reprocessed,
+        remapped or corrected) is still recognised as the one already uploaded. Batches are keyed on their entries' keys
+        '''
+        digest = hashlib.sha256('|'.join([self.realm, *parts]).encode('utf-8'))
+        return digest.hexdigest()[:32]
+
+    @staticmethod
+    def entry_name(entry):
+        return f"{entry['JournalEntry']['DocNumber']} ({entry['JournalEntry']['TxnDate']})"
+
+    def build_batches(self, entries):
+        return [entries[start:start + self.batch_size] for start in range(0, len(entries), self.batch_size)]
+
+    def upload_file(self, journal_file, source=None):
+        '''
+        Upload every journal entry in the given file, returning the results of the run
+        '''
+        entries = self.load_entries(journal_file, source)
+        started = time.monotonic()
+        asyncio.run(self.upload(entries))
+        elapsed = max(time.monotonic() - started, 1e-9)
+        print(
+            f"Uploaded {len(self.results['uploaded'])} of {len(entries)} journal entries from {journal_file} "
+            f"in {elapsed:.2f}s ({len(entries) / elapsed:.0f} entries/s)"
+        )
+        for journal_number, reason in self.results['failed'].items():
+            logging.error(f'Journal entry {journal_number} failed to upload: {reason}')
+        return self.results
+
+    async def upload(self, entries):
+        '''
+        Send every batch concurrently over one pooled session, with at most --upload-concurrency in flight
+        '''
+        try:
+            import aiohttp
+        except ImportError:
+            raise Exception("Uploading to Quickbooks requires aiohttp. Install it with pip install aiohttp")
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+
+        async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+            await asyncio.gather(*[
+                self.send_batch(session, semaphore, batch) for batch in self.build_batches(entries)
+            ])
+        return self.results
+
+    async def send_batch(self, session, semaphore, batch):
+        '''
+        Send a single batch request, retrying throttled and server errors with exponential backoff
+        A Retry-After header from the server always wins over our own backoff
+        '''
+        import aiohttp
+
+        journal_numbers = [self.entry_name(entry) for entry in batch]
+        url = f'{self.base_url}/v3/company/{self.realm}/batch'
+        params = {'requestid': self.idempotency_key(*sorted(entry['bId'] for entry in batch))}
+        body = {'BatchItemRequest': batch}
+
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                try:
+                    async with session.post(url, params=params, json=body) as response:
+                        status = response.status
+                        retry_after = response.headers.get('Retry-After')
+                        payload = await response.json(content_type=None) if status == 200 else await response.text()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status, retry_after, payload = None, None, str(e)
+
+            if status == 200:
+                self.record_batch_response(batch, payload)
+                return
+            if status is not None and status not in RETRY_STATUSES:
+                break
+            if attempt < self.max_retries:
+                delay = float(retry_after) if retry_after else min(2 ** attempt, 60) * (0.5 + random.random())
+                logging.warning(f'Batch {params["requestid"]} got {status or payload}, retrying in {delay:.2f}s')
+                await asyncio.sleep(delay)
+
+        for journal_number in journal_numbers:
+            self.results['failed'][journal_number] = f'HTTP {status}: {payload}'
+
+    def record_batch_response(self, batch, payload):
+        '''
+        A batch can succeed as a whole while individual entries fail, so check each item in the response
+        '''
+        journal_numbers = {entry['bId']: self.entry_name(entry) for entry in batch}
+        for item in payload.get('BatchItemResponse', []):
+            journal_number = journal_numbers.pop(item.get('bId'), None)
+            if journal_number is None:
+                continue
+            if 'Fault' in item:
+                self.results['failed'][journal_number] = json.dumps(item['Fault'])
+            else:
+                self.results['uploaded'].append(journal_number)
+        for journal_number in journal_numbers.values():
+            self.results['failed'][journal_number] = 'Missing from the batch response'
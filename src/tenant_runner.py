@@ -0,0 +1,281 @@
+'''
+Runs the ChowNow, Vagaro and SpotOn jobs for every business we bookkeep for on one shared pool of worker processes
+
+Each business (tenant) gets its own data directory, account mapping and list of enabled sources in the tenants file
+Jobs are handed out round robin across tenants with a cap on how many of one tenant's jobs run at once, so a
+client with years of backfill can't starve everyone else. A job that fails (or takes its worker process down with it)
+is recorded against that tenant only and every other job keeps running
+'''
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+import traceback
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+SOURCES = ['chownow', 'vagaro', 'spoton']
+DEFAULT_REPORTS = {
+    'chownow': 'DisbursementReport_*.xls*',
+    'spoton': 'Settlements_Report_*.csv',
+}
+# The journal translator writes its own columns, see autorun/data_from_journal_auto.sh
+VAGARO_JOURNAL_KEYS = "Journal No.,Journal Date,Received From,Account Name,Description,Payment Method,Ref No,Debits,Credits"
+
+
+class Tenant:
+
+    def __init__(self, config):
+        '''
+        Create a tenant from its entry in the tenants file
+
+        :param config: Dictionary with a name, data_dir, and optionally account_mapping, sources and reports
+            reports maps a source to the file pattern of its report within the data dir
+        '''
+        self.name = config['name']
+        self.data_dir = config['data_dir']
+        self.account_mapping = config.get('account_mapping')
+        self.sources = config.get('sources', SOURCES)
+        self.reports = dict(DEFAULT_REPORTS, **config.get('reports', {}))
+
+        unknown_sources = [source for source in self.sources if source not in SOURCES]
+        if unknown_sources:
+            raise Exception(f"Tenant {self.name} has unknown sources {unknown_sources}. Must be in {SOURCES}")
+
+    def build_jobs(self, date):
+        return [{'tenant': self.name, 'source': source, 'date': date} for source in self.sources]
+
+    def find_report(self, source):
+        '''
+        Pick the most recently modified report matching the source's pattern in the data dir
+        '''
+        matches = glob.glob(os.path.join(self.data_dir, self.reports[source]))
+        if not matches:
+            raise Exception(f"No {source} report matching {self.reports[source]} in {self.data_dir}")
+        return max(matches, key=os.path.getmtime)
+
+
+def load_tenants(file_path):
+    if not os.path.exists(file_path):
+        raise Exception(f"The tenants file {file_path} is missing")
+    with open(file_path) as f:
+        tenants = [Tenant(config) for config in json.load(f)['tenants']]
+
+    names = [tenant.name for tenant in tenants]
+    if len(set(names)) != len(names):
+        raise Exception(f"Tenant names must be unique. Given {names}")
+    return tenants
+
+
+def report_lines_file(tenant, date, source):
+    '''
+    Where a ChowNow or SpotOn job writes the lines for its whole report, before keep_job_date picks out its date
+    '''
+    return os.path.join(tenant.data_dir, 'intermediate', f'{date}-{source}_report_lines.csv')
+
+
+def keep_job_date(lines_file, output_file, date, source, args):
+    '''
+    The ChowNow and SpotOn reports cover many days, but each job writes one date's file. Keep only that date's lines,
+    otherwise every date's file would hold the whole report and consolidating them books each deposit again and again
+
+    The job writes the whole report's lines to lines_file, and only the lines kept are validated, so the report next
+    to the output covers what is in it. With strict validation a failed date leaves the previous output in place
+    '''
+    from dates import date_keys, parse_dates
+    from journal_schema import read_journal_file, resolve_columns
+    from journal_validator import JournalValidator
+    from output_writer import write_frame
+
+    try:
+        lines = read_journal_file(lines_file)
+        date_column = resolve_columns(lines.columns).get('journal_date')
+        if date_column is None:
+            raise Exception(f"{lines_file} doesn't have a journal date column to pick the lines for {date} from")
+        keep = (date_keys(parse_dates(lines[date_column])) == int(date)).fillna(False).to_numpy()
+        if not keep.any():
+            logging.warning(f"The report behind {output_file} has no lines dated {date}")
+
+        if not args.skip_validation:
+            validator = JournalValidator(source, strict=args.strict_validation)
+            validator.validate(lines[keep])
+            validator.write_report(output_file)
+        write_frame(lines[keep], output_file, journal_lines=args.intermediate)
+    finally:
+        if os.path.exists(lines_file):
+            os.remove(lines_file)
+
+
+def run_tenant_job(job, tenant_config, base_args):
+    '''
+    Run one source's job for one tenant and date. This runs in a worker process, so everything passed in is plain data
+
+    Nothing is raised from here: the result records whether it worked, so one bad job never affects another
+    '''
+    # Imported here so the parent process doesn't pay for loading pandas in every tenant module up front
+    from account_mapping import AccountMapping
+    from data_importer import DataImporter
+    from data_translator_from_journal import JournalDataImporter
+    from spoton_journal_entry_automation_windows import process_spoton_file
+
+    started = time.monotonic()
+    result = dict(job, status='ok', output_file=None, error=None)
+    tenant = Tenant(tenant_config)
+    args = argparse.Namespace(**dict(base_args, date=job['date'], account_mapping=tenant.account_mapping))
+    # Recorded with anything quarantined, so --reprocess-quarantine reruns it through here
+    args.tenant = tenant_config
+
+    try:
+        if job['source'] == 'chownow':
+            output_file = os.path.join(tenant.data_dir, f"{job['date']}-chownow_journal_entry.csv")
+            lines_file = report_lines_file(tenant, job['date'], 'chownow')
+            # Validation and the arrow copy wait for keep_job_date, so they only cover the job's date
+            report_args = argparse.Namespace(**dict(vars(args), file_path=tenant.find_report('chownow'),
+                                                    output_file=lines_file, skip_validation=True, intermediate=False))
+            data_importer = DataImporter(report_args)
+            if args.stream:
+                data_importer.stream_output_file()
+            else:
+                data_importer.load_data()
+                data_importer.write_output_file()
+            keep_job_date(lines_file, output_file, job['date'], 'ChowNow', args)
+            result['output_file'] = output_file
+
+        elif job['source'] == 'vagaro':
+            args.file_path = tenant.data_dir
+            args.output_dir = tenant.data_dir
+            args.journal_keys = VAGARO_JOURNAL_KEYS
+            journal_data_importer = JournalDataImporter(args)
+            journal_data_importer.build_composite_dataframe()
+            result['output_file'] = journal_data_importer.output_file
+
+        elif job['source'] == 'spoton':
+            output_file = os.path.join(tenant.data_dir, f"{job['date']}-spoton_journal_entry.csv")
+            lines_file = report_lines_file(tenant, job['date'], 'spoton')
+            mapping = AccountMapping(tenant.account_mapping).source('spoton')
+            process_spoton_file(tenant.find_report('spoton'), lines_file, validate=False, mapping=mapping)
+            keep_job_date(lines_file, output_file, job['date'], 'SpotOn', args)
+            result['output_file'] = output_file
+
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f'{e}\n{traceback.format_exc()}'
+
+    result['seconds'] = round(time.monotonic() - started, 3)
+    return result
+
+
+class TenantRunner:
+
+    def __init__(self, tenants, base_args, workers=None, max_jobs_per_tenant=1):
+        '''
+        :param tenants: The tenants to run jobs for
+        :param base_args: The parsed command line args, used as the defaults for every job
+        :param workers: Size of the shared process pool. Defaults to the number of cpus
+        :param max_jobs_per_tenant: How many of one tenant's jobs may run at the same time
+        '''
+        self.tenants = {tenant.name: tenant for tenant in tenants}
+        self.base_args = dict(vars(base_args))
+        self.workers = workers or os.cpu_count() or 1
+        self.max_jobs_per_tenant = max_jobs_per_tenant
+        self.results = []
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(load_tenants(args.tenants), args, workers=args.workers, max_jobs_per_tenant=args.max_jobs_per_tenant)
+
+    def build_jobs(self, dates):
+        return [job for date in dates for tenant in self.tenants.values() for job in tenant.build_jobs(date)]
+
+    def run(self, jobs):
+        '''
+        Run every job on the shared pool, handing them out fairly, and return one result per job
+
+        If a worker process dies we can't tell which of the jobs running on it took it down, so all of them are
+        retried one at a time on a fresh pool. Only the job that kills its worker again is recorded as failed
+        '''
+        pending = {name: deque() for name in self.tenants}
+        for job in jobs:
+            pending[job['tenant']].append(job)
+        in_flight = {name: 0 for name in self.tenants}
+        turn_order = deque(self.tenants)
+        suspects = deque()
+        running = {}
+        self.results = []
+
+        def next_job():
+            # Round robin over the tenants, skipping any with nothing left or already at their cap
+            for _ in range(len(turn_order)):
+                name = turn_order[0]
+                turn_order.rotate(-1)
+                if pending[name] and in_flight[name] < self.max_jobs_per_tenant:
+                    return pending[name].popleft()
+            return None
+
+        def submit(job):
+            running[pool.submit(run_tenant_job, job, self.tenant_config(job['tenant']), self.base_args)] = job
+            in_flight[job['tenant']] += 1
+
+        pool = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            while running or suspects or any(pending.values()):
+                if suspects:
+                    # Suspects run alone once everything else on the pool has finished
+                    if not running:
+                        submit(suspects.popleft())
+                else:
+                    while len(running) < self.workers:
+                        job = next_job()
+                        if job is None:
+                            break
+                        submit(job)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                pool_broken = False
+                for future in done:
+                    job = running.pop(future)
+                    in_flight[job['tenant']] -= 1
+                    try:
+                        self.record(future.result())
+                    except BrokenProcessPool as e:
+                        pool_broken = True
+                        if job.get('suspect'):
+                            self.record(dict(job, status='failed', output_file=None, error=f'Worker process died: {e}', seconds=None))
+                        else:
+                            suspects.append(dict(job, suspect=True))
+
+                if pool_broken:
+                    for job in running.values():
+                        in_flight[job['tenant']] -= 1
+                        suspects.append(dict(job, suspect=True))
+                    running.clear()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = ProcessPoolExecutor(max_workers=self.workers)
+        finally:
+            pool.shutdown()
+        return self.results
+
+    def tenant_config(self, name):
+        tenant = self.tenants[name]
+        return {
+            'name': tenant.name, 'data_dir': tenant.data_dir, 'account_mapping': tenant.account_mapping,
+            'sources': tenant.sources, 'reports': tenant.reports,
+        }
+
+    def record(self, result):
+        self.results.append(result)
+        if result['status'] == 'ok':
+            logging.info(f"{result['tenant']} {result['source']} {result['date']} finished in {result['seconds']}s")
+        else:
+            logging.error(f"{result['tenant']} {result['source']} {result['date']} failed: {result['error']}")
+
+    def print_summary(self):
+        failed = [result for result in self.results if result['status'] != 'ok']
+        print(f"\n✅ Finished {len(self.results) - len(failed)} of {len(self.results)} tenant jobs")
+        for result in failed:
+            print(f"❌ {result['tenant']} {result['source']} {result['date']}: {result['error'].splitlines()[0]}")
+        return not failed